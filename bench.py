@@ -0,0 +1,137 @@
+"""Offline benchmark of the polling pipeline on the in-process fake Sheets backend:
+
+    python bench.py --tables 2000 --spreadsheets 500 --latency 0.05 --ticks 10
+"""
+import argparse
+import asyncio
+import os
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import gspread
+
+from fake_sheets import FakeClient
+
+CHECKER_TYPES = ("cell", "row", "col", "sheet", "range")
+
+
+def percentile(values: List[float], share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def build_tables(args, client: FakeClient) -> list:
+    from bot import Table, subscriptions
+    from checkers import CellChecker, ColChecker, RangeChecker, RowChecker, SheetChecker
+    keys = [f"bench{index:06d}" for index in range(args.spreadsheets)]
+    for key in keys:
+        client.add_spreadsheet(key, args.worksheets, args.rows, args.cols)
+    weights = [float(weight) for weight in args.mix.split(",")]
+    rnd = client.random
+    tables = []
+    for index in range(args.tables):
+        key = keys[index % len(keys)]
+        ref = f"https://docs.google.com/spreadsheets/d/{key}/edit"
+        table = Table(ref, f"table{index}")
+        for _ in range(rnd.randint(1, args.checkers)):
+            worksheet = rnd.randrange(args.worksheets)
+            match rnd.choices(CHECKER_TYPES, weights)[0]:
+                case "cell":
+                    label = gspread.utils.rowcol_to_a1(rnd.randint(1, args.rows),
+                                                       rnd.randint(1, args.cols))
+                    table.add_checker(CellChecker(ref, worksheet, label))
+                case "row":
+                    table.add_checker(RowChecker(ref, worksheet, rnd.randint(1, args.rows)))
+                case "col":
+                    table.add_checker(ColChecker(ref, worksheet, rnd.randint(1, args.cols)))
+                case "sheet":
+                    table.add_checker(SheetChecker(ref, worksheet))
+                case "range":
+                    row, col = rnd.randint(1, args.rows), rnd.randint(1, args.cols)
+                    end = gspread.utils.rowcol_to_a1(min(args.rows, row + 19),
+                                                     min(args.cols, col + 9))
+                    label = f"{gspread.utils.rowcol_to_a1(row, col)}:{end}"
+                    table.add_checker(RangeChecker(ref, worksheet, [label]))
+        # Equal checkers of different tables are shared like in the bot
+        table.subscribe(subscriptions, ("bench", table.name))
+        tables.append(table)
+    return tables
+
+
+def poll(cycle, tables: list) -> int:
+    """The bot's poll cycle, quota admission included, for all tables at once.
+    :returns number of tables with news"""
+    return len(asyncio.run(cycle.poll([("bench", table.name) for table in tables])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", type=int, default=1000)
+    parser.add_argument("--spreadsheets", type=int, default=250)
+    parser.add_argument("--worksheets", type=int, default=2)
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--cols", type=int, default=20)
+    parser.add_argument("--checkers", type=int, default=5, help="most checkers in a table")
+    parser.add_argument("--mix", default="5,2,2,1,2",
+                        help="weights of cell, row, column, sheet and range checkers")
+    parser.add_argument("--mutation-rate", type=float, default=0.1,
+                        help="share of spreadsheets changed before every tick")
+    parser.add_argument("--mutated-cells", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per API call")
+    parser.add_argument("--ticks", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--accounts", type=int, default=1, help="service accounts in the pool")
+    parser.add_argument("--quota", type=float, default=float("inf"),
+                        help="read requests per minute of one account")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    client = FakeClient(args.latency, args.seed)
+    os.environ["SERVICE_ACCOUNT_FILES"] = ",".join(f"bench{i}.json" for i in range(args.accounts))
+    from checkers import governor, planner
+    from governor import Quota
+    for account in governor.pool.accounts:
+        account.factory = lambda _: client
+        account.quota = Quota(args.quota)
+    tables = build_tables(args, client)
+    checkers = sum(len(table.checkers) for table in tables)
+    from bot import policy, subscriptions
+    from cycle import PollCycle
+    from scheduler import PollScheduler
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    by_key = {("bench", table.name): table for table in tables}
+    cycle = PollCycle(planner, subscriptions, policy, PollScheduler(), executor,
+                      lambda key: (key, by_key[key]), lambda key, news: None, lambda checker: None)
+    poll(cycle, tables)
+
+    cycles, calls = [], []
+    cpu = time.process_time()
+    for _ in range(args.ticks):
+        for key in client.spreadsheets:
+            if client.random.random() < args.mutation_rate:
+                client.mutate(key, args.mutated_cells)
+        before = client.calls.copy()
+        start = time.perf_counter()
+        poll(cycle, tables)
+        cycles.append(time.perf_counter() - start)
+        calls.append(client.calls - before)
+    cpu = time.process_time() - cpu
+    executor.shutdown()
+
+    total = sum(cycles)
+    print(f"tables {len(tables)}, checkers {checkers} ({len(subscriptions)} unique), "
+          f"spreadsheets {args.spreadsheets}, ticks {args.ticks}")
+    print(f"throughput       {checkers * args.ticks / total:.0f} checkers/s")
+    for kind in ("version", "metadata", "values"):
+        print(f"{kind + ' calls':16} {sum(c[kind] for c in calls) / args.ticks:.1f} per tick")
+    print(f"cycle p50        {percentile(cycles, 0.5) * 1000:.1f} ms")
+    print(f"cycle p99        {percentile(cycles, 0.99) * 1000:.1f} ms")
+    print(f"cpu              {cpu:.2f} s ({cpu / total:.0%} of wall time)")
+    print(f"peak rss         {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,35 @@
+import asyncio
 import datetime
 import json
 import logging
-from typing import Dict
-
+import math
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import gspread
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import Application, CommandHandler, ContextTypes, ConversationHandler, \
     MessageHandler, filters
 
 from checkers import *
+from config import BASE_JSON, COMMAND_WORKERS, CONCURRENT_UPDATES, DUMP_INTERVAL, METRICS_HOST, \
+    METRICS_PORT, POLL_INTERVAL, POLL_TICK, POLL_WORKERS, POLLER_SHARDS, PUSH_BATCH, PUSH_DELAY, \
+    PUSH_HOST, PUSH_PORT, PUSH_TICK, PUSH_URL, SEND_TICK, WEBHOOK_URL
+from cycle import PollCycle
+from dispatcher import Dispatcher
+from httpd import serve
+from metrics import DUMP, PUSH_CHANNELS, SCHEDULER_LAG, SEND_BACKLOG, WATCHED_TABLES, \
+    handle_metrics
+from push import PushChannels, receiver
+from scheduler import AdaptivePolicy, PollScheduler
+from storage import Storage
+from subscriptions import SubscriptionIndex
+from webhook import ChatUpdateProcessor, run_webhook, used_update_types
+from workers import ShardManager
 
 # Enable logging
 logging.basicConfig(
@@ -15,31 +37,63 @@ logging.basicConfig(
 )
 
 
+# Blocking gspread calls run here, so they never stall the event loop. Commands have threads
+# of their own, they never queue behind polls
+executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix="poll")
+commands = ThreadPoolExecutor(max_workers=COMMAND_WORKERS, thread_name_prefix="command")
+
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def run_command(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(commands, func, *args)
+
+
 class Table:
     reference: str
     name: str
-    checkers: List[BaseChecker]
+    # Ordered set of checkers, a dictionary from a checker to itself
+    checkers: Dict[BaseChecker, BaseChecker]
+    interval: float
+    # Bounds of the interval pinned by the owner, None means the defaults
+    min_interval: Optional[float]
+    max_interval: Optional[float]
 
     def __init__(self, ref: str, name: str):
         self.reference = ref
         self.name = name
-        self.checkers = []
+        self.checkers = {}
+        self.interval = POLL_INTERVAL
+        self.min_interval = None
+        self.max_interval = None
 
     def add_checker(self, checker):
-        self.checkers.append(checker)
+        self.checkers[checker] = checker
 
     def del_checker(self, checker):
-        self.checkers.remove(checker)
+        """:raise KeyError if the table has no such checker"""
+        del self.checkers[checker]
 
-    def update(self) -> None:
+    def subscribe(self, index: SubscriptionIndex, subscriber: tuple) -> None:
+        """Replaces own checkers with the shared ones of the index"""
+        self.checkers = {shared: shared for shared in
+                         (index.subscribe(checker, subscriber) for checker in self.checkers)}
+
+    def unsubscribe(self, index: SubscriptionIndex, subscriber: tuple) -> None:
         for checker in self.checkers:
-            checker.update()
+            index.unsubscribe(checker, subscriber)
+
+    @property
+    def spreadsheet_id(self) -> str:
+        return extract_id_from_url(self.reference)
 
     def news(self) -> str:
         return ''.join(checker.answer for checker in self.checkers)
 
     def test(self) -> None:
-        gc.open_by_url(self.reference)
+        planner.handles.get(self.spreadsheet_id)
 
 
 class BaseNotLoaded(Exception):
@@ -51,15 +105,132 @@ def get_tables_from_user(update: Update) -> Dict[str, Table]:
     :raise BaseNotLoaded if base has not loaded
     """
     chat_id = str(update.effective_message.chat_id)
-    if not base:
+    if base is None:
         raise BaseNotLoaded
     if chat_id not in base:
         base[chat_id] = dict()
     return base[chat_id]
 
 
+def mark_dirty(update: Update, name: str) -> None:
+    """The table will be written to the storage with the next dump"""
+    dirty.add((str(update.effective_message.chat_id), name))
+
+
+def encode_table(table: Table) -> str:
+    return json.dumps(table, default=BaseHelper.encode)
+
+
+def state_key(checker: BaseChecker) -> str:
+    """:returns the key the checker's data is stored by, shared by all equal checkers"""
+    return json.dumps(checker.key, ensure_ascii=False)
+
+
+def mark_state(checker: BaseChecker) -> None:
+    """The checker's data will be written to the storage with the next dump"""
+    dirty_states[checker.key] = checker
+
+
+def watch_table(chat_id: str, table: Table) -> None:
+    """Starts polling the table here or on its poller worker"""
+    if shards is not None:
+        shards.watch((chat_id, table.name), extract_id_from_url(table.reference),
+                     encode_table(table))
+    elif (chat_id, table) not in scheduler:
+        scheduler.add((chat_id, table), table.interval)
+        spreadsheets.setdefault(extract_id_from_url(table.reference), set()).add((chat_id, table))
+
+
+def unwatch_table(chat_id: str, table: Table) -> None:
+    table.unsubscribe(subscriptions, (chat_id, table.name))
+    if shards is not None:
+        shards.unwatch((chat_id, table.name))
+    else:
+        scheduler.remove((chat_id, table))
+        key = extract_id_from_url(table.reference)
+        tables = spreadsheets.get(key, set())
+        tables.discard((chat_id, table))
+        if not tables:
+            spreadsheets.pop(key, None)
+
+
+def table_changed(update: Update, table: Table) -> None:
+    """The owner has changed the table: it is saved and its poller worker gets the new one"""
+    mark_dirty(update, table.name)
+    if shards is not None:
+        watch_table(str(update.effective_message.chat_id), table)
+
+
+async def add_to_table(update: Update, table: Table, checker: BaseChecker) -> None:
+    """Adds the checker to the table. A checker equal to one already watched anywhere is not
+    fetched, the table shares that one"""
+    if checker not in subscriptions:
+        await run_command(checker.update)
+        mark_state(checker)
+    chat_id = str(update.effective_message.chat_id)
+    table.add_checker(subscriptions.subscribe(checker, (chat_id, table.name)))
+    table_changed(update, table)
+
+
+def del_from_table(update: Update, table: Table, checker: BaseChecker) -> None:
+    """:raise KeyError if the table has no such checker"""
+    table.del_checker(checker)
+    subscriptions.unsubscribe(checker, (str(update.effective_message.chat_id), table.name))
+    table_changed(update, table)
+
+
+def touch_table(chat_id: str, table: Table) -> None:
+    """The owner works with the table, so it is polled at the shortest interval again"""
+    table.interval = policy.bounds(table.min_interval, table.max_interval)[0]
+    if shards is not None:
+        shards.touch((chat_id, table.name))
+    elif (chat_id, table) in scheduler:
+        scheduler.reschedule((chat_id, table), table.interval)
+
+
+def notify(chat_id: str, table: Table, news: str) -> None:
+    dispatcher.send(chat_id, f"Изменения в таблице {table.name}:\n\n" + news)
+
+
+def send_news(key: Tuple[str, str], news: str) -> None:
+    """Sends the news of a table by its (chat_id, name) key, a table deleted meanwhile gets none"""
+    chat_id, name = key
+    table = base.get(chat_id, {}).get(name)
+    if table is not None:
+        notify(chat_id, table, news)
+
+
 NAME_CHOOSING, REF_CHOOSING = range(2)
-base = dict()
+base: Optional[Dict[str, Dict[str, Table]]] = None
+storage: Optional[Storage] = None
+# (chat_id, name) pairs of the tables changed since the last dump
+dirty = set()
+# Checkers whose data has changed since the last dump, by key
+dirty_states: Dict[tuple, BaseChecker] = {}
+# Items are (chat_id, table) pairs
+scheduler = PollScheduler()
+# Pairs and checkers whose poll has started but not finished yet
+polling = set()
+# Scheduler items by spreadsheet key
+spreadsheets: Dict[str, set] = {}
+# Drive channels of the watched spreadsheets, None without push mode
+push: Optional[PushChannels] = None
+# Spreadsheets reported changed whose poll hasn't started yet
+pushed = set()
+# Checkers by range with the (chat_id, name) pairs of the tables watching them
+subscriptions = SubscriptionIndex()
+policy = AdaptivePolicy()
+# Polls of the tables here, the poller workers run the same cycle
+cycle = PollCycle(planner, subscriptions, policy, scheduler, executor,
+                  lambda item: ((item[0], item[1].name), item[1]), send_news, mark_state, polling)
+# Poller workers, None when the tables are polled in this process
+shards: Optional[ShardManager] = None
+dispatcher = Dispatcher()
+WATCHED_TABLES.function = lambda: len(scheduler) if shards is None else len(shards.owners)
+SEND_BACKLOG.function = lambda: dispatcher.backlog
+PUSH_CHANNELS.function = lambda: 0 if push is None else len(push)
+# Servers started on the loop, kept here so they live as long as the bot
+servers = []
 
 
 async def start_creating_table(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -96,27 +267,90 @@ async def get_table_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def create_new_table(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Create new table"""
-    chat_id = update.effective_message.chat_id
+    chat_id = str(update.effective_message.chat_id)
     ref, name = context.user_data["current_ref"], context.user_data["current_name"]
     table = Table(ref, name)
-    table.test()
+    await run_command(table.test)
 
     table_by_name = get_tables_from_user(update)
     table_by_name[name] = table
-    context.job_queue.run_repeating(update_table, interval=datetime.timedelta(minutes=1),
-                                    chat_id=chat_id,
-                                    data=table)
+    mark_dirty(update, name)
+    watch_table(chat_id, table)
     await update.effective_message.reply_text("Таблица успешно создана!")
 
 
-async def update_table(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    table: Table = job.data
-    table.update()
-    news = table.news()
-    if news:
-        await context.bot.send_message(job.chat_id, f"Изменения в таблице {table.name}:\n\n" +
-                                       news)
+async def poll_due_tables(context: ContextTypes.DEFAULT_TYPE):
+    """Starts polls of the tables whose time has come. A table is skipped while its previous
+    poll is still running"""
+    SCHEDULER_LAG.set(scheduler.lag())
+    due = [item for item in scheduler.pop_due()
+           if item not in polling and not pushes_changes(item[1])]
+    if due:
+        polling.update(due)
+        context.application.create_task(update_tables(context, due))
+
+
+def pushes_changes(table: Table) -> bool:
+    """Changes of the table's spreadsheet come from its Drive channel, so the scheduler skips it"""
+    return push is not None and push.live(extract_id_from_url(table.reference))
+
+
+def push_changed(app: Application, key: str) -> None:
+    """Polls the tables of the spreadsheet soon. Later notifications until then are one poll"""
+    if key not in pushed:
+        pushed.add(key)
+        app.job_queue.run_once(poll_pushed, PUSH_DELAY, data=key)
+
+
+async def poll_pushed(context: ContextTypes.DEFAULT_TYPE):
+    """Polls the tables of a changed spreadsheet. Tables whose poll is running are polled once
+    more after it, that poll may have read the spreadsheet before the change"""
+    key = context.job.data
+    pushed.discard(key)
+    tables = spreadsheets.get(key, set())
+    due = [item for item in tables if item not in polling]
+    if due:
+        polling.update(due)
+        context.application.create_task(update_tables(context, due))
+    if len(due) < len(tables):
+        push_changed(context.application, key)
+
+
+async def renew_channels(context: ContextTypes.DEFAULT_TYPE):
+    """Opens channels of newly watched spreadsheets, renews expiring ones and closes the ones
+    nobody watches. A spreadsheet is polled once its channel is opened or has lapsed, changes
+    since its last poll would be missed otherwise"""
+    for key in push.lapsed():
+        logging.warning("Channel of spreadsheet %s has lapsed, it is polled on schedule", key)
+        if key in spreadsheets:
+            push_changed(context.application, key)
+    opened = push.due(spreadsheets)[:PUSH_BATCH]
+    fresh = {key for key in opened if not push.live(key)}
+    closed = [key for key in list(push.channels) if key not in spreadsheets][:PUSH_BATCH]
+    results = await asyncio.gather(*(run_blocking(push.open, key) for key in opened),
+                                   *(run_blocking(push.close, key) for key in closed),
+                                   return_exceptions=True)
+    for key, result in zip(opened + closed, results):
+        if isinstance(result, Exception):
+            logging.error("Can't open or close the channel of spreadsheet %s", key,
+                          exc_info=result)
+        elif key in fresh:
+            push_changed(context.application, key)
+
+
+def defer_table(app: Application, item: tuple) -> None:
+    """A table of a spreadsheet without reads free for polls is polled on a later tick, or
+    soon after, when its changes come from a Drive channel"""
+    if pushes_changes(item[1]):
+        push_changed(app, item[1].spreadsheet_id)
+    else:
+        scheduler.postpone(item, POLL_TICK)
+
+
+async def update_tables(context: ContextTypes.DEFAULT_TYPE, tables: List[tuple]):
+    """Polls tables with one values request per spreadsheet. A checker shared by several
+    tables is polled once and its news go to all of them, due or not"""
+    await cycle.poll(tables, partial(defer_table, context.application))
 
 
 async def help_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -124,10 +358,53 @@ async def help_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Это бот для наблюдением за гугл таблицами. Чтобы следить за таблицей, нужно"
         " создать таблицу и затем создать на неё чекер Чтобы создать таблицу используй команду"
         " /add_table. Чтобы добавить чекер введите команду /add_checker. Чтобы удалить используй"
-        " команды /delete_table и /delete_checker."
+        " команды /delete_table и /delete_checker. Чтобы задать, как часто проверять таблицу,"
+        " используй /set_interval <имя таблицы> <минимум в минутах> [максимум в минутах]."
     )
 
 
+def parse_interval(args: List[str], names) -> Tuple[str, List[float]]:
+    """Splits /set_interval arguments into a table name and one or two bounds in seconds.
+    A name may end in a number, so the split naming an existing table with valid bounds wins"""
+    splits = []
+    for count in (2, 1):
+        if len(args) <= count:
+            continue
+        try:
+            bounds = [float(arg) * 60 for arg in args[-count:]]
+        except ValueError:
+            continue
+        # NaN would break the order of the scheduler heap
+        valid = all(map(math.isfinite, bounds)) and min(bounds) > 0 and bounds == sorted(bounds)
+        splits.append((' '.join(args[:-count]), bounds if valid else []))
+    if not splits:
+        return ' '.join(args), []
+    return max(splits, key=lambda split: (split[0] in names, bool(split[1])))
+
+
+async def set_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/set_interval <name> <min minutes> [max minutes], the name may contain spaces"""
+    tables_by_name = get_tables_from_user(update)
+    name, bounds = parse_interval(list(context.args), tables_by_name)
+    if not bounds:
+        await update.effective_message.reply_text(
+            "Используйте /set_interval <имя таблицы> <минимум в минутах> [максимум в минутах]")
+        return
+    if name not in tables_by_name:
+        await update.effective_message.reply_text("Такой таблицы нет. Попробуйте ещё раз")
+        return
+    table = tables_by_name[name]
+    table.min_interval = max(policy.minimum, bounds[0])
+    table.max_interval = max(table.min_interval, bounds[1]) if len(bounds) == 2 else None
+    table_changed(update, table)
+    touch_table(str(update.effective_message.chat_id), table)
+    if table.min_interval > bounds[0]:
+        await update.effective_message.reply_text(
+            f"Готово! Чаще чем раз в {policy.minimum / 60:g} мин таблицы не проверяются")
+        return
+    await update.effective_message.reply_text("Готово!")
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.effective_message.reply_text(
         "Привет, это бот для наблюдением за гугл таблицами. Чтобы следить за таблицей, нужно"
@@ -138,7 +415,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 (HOW_TO_CHOOSE_TABLE, TABLE_CHOOSING_BY_REF, TABLE_CHOOSING_BY_NAME, WORKSHEET_CHOOSING,
- TYPE_CHOOSING, TARGET_CHOOSING, CELL, ROW, COLUMN, ALL) = range(10)
+ TYPE_CHOOSING, TARGET_CHOOSING, CELL, ROW, COLUMN, ALL, RANGE) = range(11)
 
 
 async def add_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -154,6 +431,7 @@ async def get_checker_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = update.message.text
     try:
         context.user_data["current_table"] = get_tables_from_user(update)[name]
+        touch_table(str(update.effective_message.chat_id), context.user_data["current_table"])
         await update.effective_message.reply_text("Отлично! Теперь выберете номер листа")
         return WORKSHEET_CHOOSING
     except KeyError:
@@ -165,7 +443,7 @@ async def get_checker_worksheet(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         index = int(update.message.text)
         context.user_data["current_worksheet"] = index
-        reply_keyboard = [["Одна ячейка", "Строка"], ["Столбец", "Весь лист"]]
+        reply_keyboard = [["Одна ячейка", "Строка", "Столбец"], ["Диапазон", "Весь лист"]]
         await update.effective_message.reply_text("Теперь выберете тип чекера",
                                                   reply_markup=
                                                   ReplyKeyboardMarkup(reply_keyboard,
@@ -191,6 +469,11 @@ async def get_checker_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.effective_message.reply_text("Напишите номер столбца",
                                                       reply_markup=ReplyKeyboardRemove())
             return COLUMN
+        case "Диапазон":
+            await update.effective_message.reply_text(
+                "Напишите диапазон, например B2:K40. Несколько диапазонов разделите запятыми",
+                reply_markup=ReplyKeyboardRemove())
+            return RANGE
         case "Весь лист":
             reply_keyboard = [["Да", "Нет"]]
             await update.effective_message.reply_text("Вы уверены?",
@@ -206,8 +489,8 @@ async def get_checker_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def add_cell_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = update.message.text
     table = context.user_data["current_table"]
-    table.add_checker(
-        CellChecker(table.reference, context.user_data["current_worksheet"], answer))
+    checker = CellChecker(table.reference, context.user_data["current_worksheet"], answer)
+    await add_to_table(update, table, checker)
     await update.effective_message.reply_text("Готово!")
     return ConversationHandler.END
 
@@ -215,8 +498,8 @@ async def add_cell_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def add_row_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = int(update.message.text)
     table = context.user_data["current_table"]
-    table.add_checker(
-        RowChecker(table.reference, context.user_data["current_worksheet"], answer))
+    checker = RowChecker(table.reference, context.user_data["current_worksheet"], answer)
+    await add_to_table(update, table, checker)
     await update.effective_message.reply_text("Готово!")
     return ConversationHandler.END
 
@@ -224,8 +507,8 @@ async def add_row_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def add_col_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = int(update.message.text)
     table = context.user_data["current_table"]
-    table.add_checker(
-        ColChecker(table.reference, context.user_data["current_worksheet"], answer))
+    checker = ColChecker(table.reference, context.user_data["current_worksheet"], answer)
+    await add_to_table(update, table, checker)
     await update.effective_message.reply_text("Готово!")
     return ConversationHandler.END
 
@@ -234,11 +517,26 @@ async def add_worksheet_checker(update: Update, context: ContextTypes.DEFAULT_TY
     if update.message.text != "Да":
         return await cancel()(update, context)
     table = context.user_data["current_table"]
-    table.add_checker(SheetChecker(table.reference, context.user_data["current_worksheet"]))
+    checker = SheetChecker(table.reference, context.user_data["current_worksheet"])
+    await add_to_table(update, table, checker)
     await update.effective_message.reply_text("Готово!", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
+async def add_range_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        ranges = RangeChecker.parse(update.message.text)
+    except ValueError:
+        await update.effective_message.reply_text(
+            "Это не диапазон. Напишите его так: B2:K40 или B2:K40, M1:M5")
+        return RANGE
+    table = context.user_data["current_table"]
+    checker = RangeChecker(table.reference, context.user_data["current_worksheet"], ranges)
+    await add_to_table(update, table, checker)
+    await update.effective_message.reply_text("Готово!")
+    return ConversationHandler.END
+
+
 def cancel(message: str = "Хорошо, в другой раз добавим"):
     async def inner(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(message)
@@ -253,7 +551,9 @@ async def del_by_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if name not in tables_by_name:
         await update.effective_message.reply_text("Такой таблицы нет. Попробуйте ещё раз")
         return TABLE_CHOOSING_BY_NAME
+    unwatch_table(str(update.effective_message.chat_id), tables_by_name[name])
     del tables_by_name[name]
+    mark_dirty(update, name)
     await update.effective_message.reply_text("Таблица успешно удалена")
     return ConversationHandler.END
 
@@ -262,9 +562,9 @@ async def del_cell_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = update.message.text
     table = context.user_data["current_table"]
     try:
-        table.del_checker(
-            CellChecker(table.reference, context.user_data["current_worksheet"], answer))
-    except ValueError:
+        del_from_table(update, table,
+                       CellChecker(table.reference, context.user_data["current_worksheet"], answer))
+    except KeyError:
         await update.effective_message.reply_text(
             "Такого чекера нет. Попробуйте ещё раз. Выберете лист таблицы")
         return WORKSHEET_CHOOSING
@@ -276,9 +576,9 @@ async def del_row_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = int(update.message.text)
     table = context.user_data["current_table"]
     try:
-        table.del_checker(
-            RowChecker(table.reference, context.user_data["current_worksheet"], answer))
-    except ValueError:
+        del_from_table(update, table,
+                       RowChecker(table.reference, context.user_data["current_worksheet"], answer))
+    except KeyError:
         await update.effective_message.reply_text(
             "Такого чекера нет. Попробуйте ещё раз. Выберете лист таблицы")
         return WORKSHEET_CHOOSING
@@ -290,9 +590,9 @@ async def del_col_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = int(update.message.text)
     table = context.user_data["current_table"]
     try:
-        table.del_checker(
-            ColChecker(table.reference, context.user_data["current_worksheet"], answer))
-    except ValueError:
+        del_from_table(update, table,
+                       ColChecker(table.reference, context.user_data["current_worksheet"], answer))
+    except KeyError:
         await update.effective_message.reply_text(
             "Такого чекера нет. Попробуйте ещё раз. Выберете лист таблицы")
         return WORKSHEET_CHOOSING
@@ -305,8 +605,9 @@ async def del_worksheet_checker(update: Update, context: ContextTypes.DEFAULT_TY
         return await cancel("Хорошо, в другой раз удалим")(update, context)
     table = context.user_data["current_table"]
     try:
-        table.del_checker(SheetChecker(table.reference, context.user_data["current_worksheet"]))
-    except ValueError:
+        del_from_table(update, table,
+                       SheetChecker(table.reference, context.user_data["current_worksheet"]))
+    except KeyError:
         await update.effective_message.reply_text(
             "Такого чекера нет. Попробуйте ещё раз. Выберете лист таблицы")
         return WORKSHEET_CHOOSING
@@ -314,6 +615,34 @@ async def del_worksheet_checker(update: Update, context: ContextTypes.DEFAULT_TY
     return ConversationHandler.END
 
 
+async def del_range_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        ranges = RangeChecker.parse(update.message.text)
+    except ValueError:
+        await update.effective_message.reply_text(
+            "Это не диапазон. Напишите его так: B2:K40 или B2:K40, M1:M5")
+        return RANGE
+    table = context.user_data["current_table"]
+    try:
+        del_from_table(update, table,
+                       RangeChecker(table.reference, context.user_data["current_worksheet"],
+                                    ranges))
+    except KeyError:
+        await update.effective_message.reply_text(
+            "Такого чекера нет. Попробуйте ещё раз. Выберете лист таблицы")
+        return WORKSHEET_CHOOSING
+    await update.effective_message.reply_text("Готово!")
+    return ConversationHandler.END
+
+
+def resize_shards(step: int) -> None:
+    """Adds or retires a poller worker, the last one is never retired"""
+    count = max(1, len(shards) + step)
+    if count != len(shards):
+        shards.resize(count)
+        logging.info("Poller shards are resized to %d", count)
+
+
 class BaseHelper:
     @staticmethod
     def decode(data: dict):
@@ -321,32 +650,58 @@ class BaseHelper:
             return data
         if data["type"] == "Table":
             tab = Table(data["ref"], data["name"])
+            tab.min_interval = data.get("min_interval")
+            tab.max_interval = data.get("max_interval")
+            tab.interval = policy.bounds(tab.min_interval, tab.max_interval)[0]
             for checker in data["checkers"]:
                 tab.add_checker(checker)
             return tab
         else:
             if "target" in data:
-                return CellChecker(data["ref"], data["index"], data["target"])
+                checker = CellChecker(data["ref"], data["index"], data["target"])
             elif "row_index" in data:
-                return RowChecker(data["ref"], data["index"], data["row_index"])
+                checker = RowChecker(data["ref"], data["index"], data["row_index"])
             elif "col_index" in data:
-                return CellChecker(data["ref"], data["index"], data["col_index"])
+                checker = ColChecker(data["ref"], data["index"], data["col_index"])
+            elif "ranges" in data:
+                checker = RangeChecker(data["ref"], data["index"], data["ranges"])
             else:
-                return SheetChecker(data["ref"], data["index"])
+                checker = SheetChecker(data["ref"], data["index"])
+            # Checkers saved with their data start without asking Google. The data of the
+            # JSON base and of old databases is moved to the states with the next dump
+            if "data" in data:
+                checker.restore(data["data"], data.get("version"))
+                checker.dirty = True
+            elif "state" in data:
+                checker.defer(lambda state=data["state"]: state, data.get("version"))
+            return checker
+
+    @staticmethod
+    def define(checker: BaseChecker) -> dict:
+        """:returns what the checker watches, without its data"""
+        answer = {"ref": checker.reference, "index": checker.worksheet_index, "type": "Checker"}
+        if isinstance(checker, CellChecker):
+            answer["target"] = checker.target
+        elif isinstance(checker, RowChecker):
+            answer["row_index"] = checker.row_index
+        elif isinstance(checker, ColChecker):
+            answer["col_index"] = checker.col_index
+        elif isinstance(checker, RangeChecker):
+            answer["ranges"] = checker.ranges
+        return answer
 
     @staticmethod
     def encode(obj) -> dict:
         if isinstance(obj, Table):
             return {"name": obj.name, "ref": obj.reference, "type": "Table",
-                    "checkers": obj.checkers}
+                    "min_interval": obj.min_interval, "max_interval": obj.max_interval,
+                    "checkers": list(obj.checkers)}
         if isinstance(obj, BaseChecker):
-            answer = {"ref": obj.reference, "index": obj.worksheet_index, "type": "Checker"}
-            if isinstance(obj, CellChecker):
-                answer["target"] = obj.target
-            elif isinstance(obj, RowChecker):
-                answer["row_index"] = obj.row_index
-            elif isinstance(obj, ColChecker):
-                answer["col_index"] = obj.col_index
+            answer = BaseHelper.define(obj)
+            # Data goes to the poller workers as it is stored, so it's decoded only there
+            if obj.fed:
+                answer["state"] = obj.state()
+                answer["version"] = obj.version
             return answer
         return obj
 
@@ -354,94 +709,247 @@ class BaseHelper:
         self.app = app
 
     def __enter__(self):
-        global base
-        with open("base.json") as f:
-            base = json.load(f, object_hook=self.decode)
+        global base, storage, shards, push
+        storage = Storage()
+        imported = storage.is_empty() and os.path.exists(BASE_JSON)
+        if imported:
+            with open(BASE_JSON) as f:
+                base = json.load(f, object_hook=self.decode)
+        else:
+            base = storage.load(self.decode)
+            self.restore_states()
         logging.info("Base has loaded")
+        if POLLER_SHARDS:
+            shards = ShardManager(POLLER_SHARDS, self.payload, governor.share)
         for chat_id, tup in base.items():
             tab_by_name: dict = tup
             for table in tab_by_name.values():
-                self.app.job_queue.run_repeating(update_table,
-                                                 interval=datetime.timedelta(minutes=1),
-                                                 chat_id=chat_id,
-                                                 data=table)
-        logging.info("Tables' jobs restored")
-        self.app.job_queue.run_repeating(self.as_dump, interval=datetime.timedelta(seconds=10))
+                table.subscribe(subscriptions, (chat_id, table.name))
+                # Tables with inline data are written again with it in the states
+                if imported or any(checker.dirty for checker in table.checkers):
+                    dirty.add((chat_id, table.name))
+                    for checker in table.checkers:
+                        if checker.dirty:
+                            mark_state(checker)
+                watch_table(chat_id, table)
+        self.dump()
+        if imported:
+            logging.info("Base has imported from %s", BASE_JSON)
+        self.app.job_queue.run_repeating(poll_due_tables if shards is None else self.collect,
+                                         interval=datetime.timedelta(seconds=POLL_TICK))
+        logging.info("Tables' polling has scheduled")
+        self.app.job_queue.run_repeating(dispatcher.flush,
+                                         interval=datetime.timedelta(seconds=SEND_TICK))
+        self.app.job_queue.run_repeating(self.as_dump,
+                                         interval=datetime.timedelta(seconds=DUMP_INTERVAL))
         logging.info("Base update's job has set")
+        if METRICS_PORT:
+            self.app.job_queue.run_once(self.start_metrics, when=0)
+        if shards is not None:
+            self.app.job_queue.run_once(self.start_resizing, when=0)
+        if PUSH_URL and shards is not None:
+            logging.warning("Push mode works without poller shards, the tables are polled")
+        elif PUSH_URL:
+            push = PushChannels(governor, PUSH_URL)
+            self.app.job_queue.run_once(self.start_push, when=0)
+            self.app.job_queue.run_repeating(renew_channels, first=1,
+                                             interval=datetime.timedelta(seconds=PUSH_TICK))
+
+    @staticmethod
+    def restore_states() -> None:
+        """Checkers get their versions now and their data on the first poll that needs it,
+        so startup doesn't read and decode every saved grid"""
+        versions = storage.versions()
+        for tab_by_name in base.values():
+            for table in tab_by_name.values():
+                for checker in table.checkers:
+                    key = state_key(checker)
+                    if key in versions:
+                        checker.defer(partial(storage.state, key), versions[key])
+
+    @staticmethod
+    def payload(key: tuple) -> Optional[str]:
+        chat_id, name = key
+        table = base.get(chat_id, {}).get(name)
+        return None if table is None else encode_table(table)
+
+    @staticmethod
+    async def collect(*args, **kwargs):
+        """Sends the news of the poller workers and takes their checkers' states for the dump.
+        States stay JSON here, only the workers decode them"""
+        for kind, key, payload in shards.collect():
+            if kind == "news":
+                send_news(key, payload)
+                continue
+            checker = subscriptions.checkers.get(key)
+            if checker is not None:
+                version, data = payload
+                checker.defer(lambda data=data: data, version)
+                mark_state(checker)
+
+    @staticmethod
+    async def start_metrics(*args, **kwargs):
+        servers.append(await serve({"/metrics": handle_metrics}, METRICS_HOST, METRICS_PORT))
+        logging.info("Metrics are on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+    @staticmethod
+    async def start_resizing(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, resize_shards, 1)
+        loop.add_signal_handler(signal.SIGUSR2, resize_shards, -1)
+
+    @staticmethod
+    async def start_push(context: ContextTypes.DEFAULT_TYPE):
+        receive = receiver(push, lambda key: push_changed(context.application, key))
+        servers.append(await serve({urlsplit(PUSH_URL).path or "/": receive},
+                                   PUSH_HOST, PUSH_PORT))
+        logging.info("Drive notifications %s are on %s:%s", PUSH_URL, PUSH_HOST, PUSH_PORT)
+
+    @staticmethod
+    def close_channel(key: str) -> None:
+        try:
+            push.close(key)
+        except Exception:
+            logging.exception("Can't close the channel of spreadsheet %s", key)
+
+    @staticmethod
+    def changes() -> Tuple[List[tuple], List[tuple]]:
+        """Takes the dirty tables and checkers and encodes them for the storage. Tables refer
+        to the states of their checkers, so a shared checker's data is written once
+        :returns table changes and (checker, key, version, data, saved) states"""
+        changes = []
+        while dirty:
+            chat_id, name = dirty.pop()
+            table = base.get(chat_id, {}).get(name)
+            if table is None:
+                changes.append((chat_id, name, None))
+                continue
+            encoded = BaseHelper.encode(table)
+            encoded["checkers"] = [(json.dumps(BaseHelper.define(checker)), state_key(checker))
+                                   for checker in table.checkers]
+            changes.append((chat_id, name, encoded))
+        states = []
+        while dirty_states:
+            _, checker = dirty_states.popitem()
+            checker.dirty = False
+            # A checker nobody watches anymore has its state deleted by the storage
+            if checker.fed and checker in subscriptions:
+                states.append((checker, state_key(checker), checker.version, checker.state(),
+                               checker.saved))
+        return changes, states
+
+    @staticmethod
+    def write(changes: List[tuple], states: List[tuple]) -> None:
+        try:
+            with DUMP.time():
+                storage.write(changes, [state[1:4] for state in states])
+        except Exception:
+            dirty.update((chat_id, name) for chat_id, name, _ in changes)
+            for checker, *_ in states:
+                mark_state(checker)
+            raise
+        for checker, key, _, _, saved in states:
+            # States of the workers are read back from the storage instead of kept here
+            if saved is not None and checker.saved is saved:
+                checker.saved = partial(storage.state, key)
+        logging.info("Base has dumped %d tables and %d checkers", len(changes), len(states))
 
     @staticmethod
     async def as_dump(*args, **kwargs):
-        BaseHelper.dump()
+        # Tables are encoded on the loop, where handlers change them, and written in a thread
+        changes, states = BaseHelper.changes()
+        if changes or states:
+            await run_blocking(BaseHelper.write, changes, states)
 
     @staticmethod
     def dump(*args, **kwargs):
-        with open("base.json", 'w') as f:
-            json.dump(base, f, default=BaseHelper.encode, indent=2)
-        logging.info("Base has dumped")
+        changes, states = BaseHelper.changes()
+        if changes or states:
+            BaseHelper.write(changes, states)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if shards is not None:
+            shards.stop()
+        if push is not None:
+            # Drive would notify the stopped bot until the channels expire
+            list(executor.map(self.close_channel, list(push.channels)))
         self.dump()
+        storage.close()
+
+
+def add_handlers(app: Application) -> List[str]:
+    """Registers the handlers of the bot
+    :returns update types they use"""
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("add_table", start_creating_table)],
+        states={
+            NAME_CHOOSING: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_table_name)],
+            REF_CHOOSING: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_table_ref)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel())]
+    )
+    app.add_handler(conv_handler)
+    app.add_handler(CommandHandler("help", help_info))
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("set_interval", set_interval))
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("add_checker", add_checker)],
+        states={
+            TABLE_CHOOSING_BY_NAME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_name)],
+            WORKSHEET_CHOOSING: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_worksheet)],
+            TYPE_CHOOSING: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_type)],
+            CELL: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_cell_checker)],
+            ROW: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_row_checker)],
+            COLUMN: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_col_checker)],
+            RANGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_range_checker)],
+            ALL: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_worksheet_checker)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel())]
+    )
+    app.add_handler(conv_handler)
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("delete_table", add_checker)],
+        states={
+            TABLE_CHOOSING_BY_NAME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, del_by_name)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel("Хорошо, в другой раз удалим"))]
+    )
+    app.add_handler(conv_handler)
+
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("delete_checker", add_checker)],
+        states={
+            TABLE_CHOOSING_BY_NAME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_name)],
+            WORKSHEET_CHOOSING: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_worksheet)],
+            TYPE_CHOOSING: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_type)],
+            CELL: [MessageHandler(filters.TEXT & ~filters.COMMAND, del_cell_checker)],
+            ROW: [MessageHandler(filters.TEXT & ~filters.COMMAND, del_row_checker)],
+            COLUMN: [MessageHandler(filters.TEXT & ~filters.COMMAND, del_col_checker)],
+            RANGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, del_range_checker)],
+            ALL: [MessageHandler(filters.TEXT & ~filters.COMMAND, del_worksheet_checker)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel("Хорошо, в другой раз удалим"))]
+    )
+    app.add_handler(conv_handler)
+    return used_update_types(handler for handlers in app.handlers.values()
+                             for handler in handlers)
 
 
 def main():
     with open("token.txt") as f:
-        app = Application.builder().token(f.readline()).build()
+        app = Application.builder().token(f.readline()) \
+            .concurrent_updates(ChatUpdateProcessor(CONCURRENT_UPDATES)).build()
+    allowed_updates = add_handlers(app)
     with BaseHelper(app):
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("add_table", start_creating_table)],
-            states={
-                NAME_CHOOSING: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_table_name)],
-                REF_CHOOSING: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_table_ref)]
-            },
-            fallbacks=[CommandHandler("cancel", cancel())]
-        )
-        app.add_handler(conv_handler)
-        app.add_handler(CommandHandler("help", help_info))
-        app.add_handler(CommandHandler("start", start))
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("add_checker", add_checker)],
-            states={
-                TABLE_CHOOSING_BY_NAME: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_name)],
-                WORKSHEET_CHOOSING: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_worksheet)],
-                TYPE_CHOOSING: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_type)],
-                CELL: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_cell_checker)],
-                ROW: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_row_checker)],
-                COLUMN: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_col_checker)],
-                ALL: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_worksheet_checker)]
-            },
-            fallbacks=[CommandHandler("cancel", cancel())]
-        )
-        app.add_handler(conv_handler)
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("delete_table", add_checker)],
-            states={
-                TABLE_CHOOSING_BY_NAME: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, del_by_name)],
-            },
-            fallbacks=[CommandHandler("cancel", cancel("Хорошо, в другой раз удалим"))]
-        )
-        app.add_handler(conv_handler)
-
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("delete_checker", add_checker)],
-            states={
-                TABLE_CHOOSING_BY_NAME: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_name)],
-                WORKSHEET_CHOOSING: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_worksheet)],
-                TYPE_CHOOSING: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_checker_type)],
-                CELL: [MessageHandler(filters.TEXT & ~filters.COMMAND, del_cell_checker)],
-                ROW: [MessageHandler(filters.TEXT & ~filters.COMMAND, del_row_checker)],
-                COLUMN: [MessageHandler(filters.TEXT & ~filters.COMMAND, del_col_checker)],
-                ALL: [MessageHandler(filters.TEXT & ~filters.COMMAND, del_worksheet_checker)]
-            },
-            fallbacks=[CommandHandler("cancel", cancel("Хорошо, в другой раз удалим"))]
-        )
-        app.add_handler(conv_handler)
-
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        if WEBHOOK_URL:
+            run_webhook(app, allowed_updates)
+        else:
+            app.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == '__main__':
@@ -1,35 +1,137 @@
+import json
+import re
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Callable, List, Optional
 
-import gspread
+from gspread.utils import a1_to_rowcol, extract_id_from_url, rowcol_to_a1
 
-gc = gspread.service_account(filename='my-python-project-394918-c67628393454.json')
+from diff import Change, diff_cells, diff_grids, diff_snapshots, \
+    diff_snapshots_aligned, render, render_events
+from config import ALIGN_ROWS, SERVICE_ACCOUNT_FILES
+from fetcher import A1_RANGE, FetchPlanner, range_start
+from governor import AccountPool, Governor
+from metrics import CHECKER_GET_DATA, CHECKER_GET_NEWS, CHECKER_UPDATE, DIFF_SIZE, \
+    OPEN_BREAKERS, SNAPSHOT_BYTES
+from snapshots import Snapshot, SnapshotStore
+
+governor = Governor(AccountPool.from_files(SERVICE_ACCOUNT_FILES))
+planner = FetchPlanner(governor)
+OPEN_BREAKERS.function = lambda: governor.breaker.open
+snapshots = SnapshotStore()
+SNAPSHOT_BYTES.function = lambda: snapshots.resident
 
 
 class BaseChecker(ABC):
     """Base class of table checkers"""
     reference: str
+    spreadsheet_id: str
     worksheet_index: int
     answer: str
+    # What get_news found, answer is rendered from it
+    changes: List[Change]
+    # Drive version of the spreadsheet when the checker was fed last time
+    version: Optional[str]
+    # False until the first data, which is taken as a baseline without news
+    fed: bool
+    # Data has changed since it was written to the storage
+    dirty: bool
+    # Returns the saved data as JSON, None if it's gone. It's decoded on the first poll, so
+    # checkers whose spreadsheets don't change are never decoded
+    saved: Optional[Callable[[], Optional[str]]]
+    # Shape of the values get_data takes: "ROWS" or "COLUMNS", a list per column
+    major_dimension = "ROWS"
 
     def __init__(self, ref: str, worksheet: int):
         self.reference = ref
+        self.spreadsheet_id = extract_id_from_url(ref)
         self.worksheet_index = worksheet
         self.data = []
         self.answer = ''
+        self.changes = []
+        self.version = None
+        self.fed = False
+        self.dirty = False
+        self.saved = None
+
+    @property
+    def key(self) -> tuple:
+        """Identity of the watched range, checkers with equal keys report the same news"""
+        return type(self).__name__, self.spreadsheet_id, self.worksheet_index, self.get_range()
 
     def __eq__(self, other):
-        return (isinstance(other, BaseChecker) and self.reference == other.reference and
-                self.worksheet_index == other.worksheet_index)
+        return isinstance(other, BaseChecker) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def update(self) -> None:
-        sh = gc.open_by_url(self.reference)
-        new_data = self.get_data(sh.get_worksheet(self.worksheet_index))
-        self.get_news(new_data)
+        with CHECKER_UPDATE.time(checker=type(self).__name__):
+            planner.fetch([self])
+
+    def feed(self, *values: List[List[str]]) -> None:
+        """Takes values of the checker's ranges fetched by the planner"""
+        self.load()
+        kind = type(self).__name__
+        with CHECKER_GET_DATA.time(checker=kind):
+            new_data = self.get_data(*values)
+        if self.fed:
+            with CHECKER_GET_NEWS.time(checker=kind):
+                self.get_news(new_data)
+            DIFF_SIZE.observe(len(self.changes), checker=kind)
+            self.dirty = self.dirty or bool(self.answer)
+        else:
+            self.answer = ''
+            self.changes = []
+            self.fed = self.dirty = True
         self.data = new_data
 
+    def dump_data(self):
+        """:returns data in a form that can be saved to JSON"""
+        return self.data
+
+    def restore(self, data, version: Optional[str]) -> None:
+        """Sets data saved with dump_data, so the checker works without fetching a baseline"""
+        self.data = data
+        self.version = version
+        self.fed = True
+        self.saved = None
+
+    def defer(self, saved: Callable[[], Optional[str]], version: Optional[str]) -> None:
+        """Same as restore, but the data is read and decoded when it's needed first"""
+        self.saved = saved
+        self.version = version
+        self.fed = True
+
+    def load(self) -> None:
+        """Restores the deferred data. Without it the next data is taken as a baseline"""
+        if self.saved is None:
+            return
+        saved, self.saved = self.saved, None
+        data = saved()
+        if data is None:
+            self.fed = False
+        else:
+            self.restore(json.loads(data), self.version)
+
+    def state(self) -> str:
+        """:returns the data as JSON, deferred data without decoding it"""
+        data = self.saved() if self.saved is not None else None
+        return json.dumps(self.dump_data()) if data is None else data
+
+    def release(self) -> None:
+        """Frees what the checker keeps outside itself, nobody watches its range anymore"""
+
     @abstractmethod
-    def get_data(self, wh: gspread.Worksheet):
+    def get_range(self) -> str:
+        """:returns A1 range inside the worksheet, empty string for the whole worksheet"""
+        raise NotImplementedError
+
+    def get_ranges(self) -> List[str]:
+        """:returns ranges to fetch, get_data takes values of each of them"""
+        return [self.get_range()]
+
+    @abstractmethod
+    def get_data(self, values: List[List[str]]):
         raise NotImplementedError
 
     @abstractmethod
@@ -44,18 +146,18 @@ class CellChecker(BaseChecker):
         super().__init__(ref, worksheet)
         self.target = target
         self.data = None
-        self.update()
 
-    def __eq__(self, other):
-        return super().__eq__(other) and isinstance(other,
-                                                    CellChecker) and other.target == self.target
+    def get_range(self) -> str:
+        return self.target
 
-    def get_data(self, wh: gspread.Worksheet):
-        return wh.acell(self.target).value
+    def get_data(self, values: List[List[str]]):
+        return values[0][0] if values and values[0] else None
 
     def get_news(self, new_data: List) -> None:
+        self.changes = []
         self.answer = ''
         if self.data != new_data:
+            self.changes = [Change(*a1_to_rowcol(self.target), self.data, new_data)]
             self.answer = f"Ячейка {self.target} изменена с {self.data} на {new_data}\n"
 
 
@@ -65,80 +167,128 @@ class RowChecker(BaseChecker):
     def __init__(self, ref: str, worksheet: int, row_index: int):
         super().__init__(ref, worksheet)
         self.row_index = row_index
-        self.update()
 
-    def __eq__(self, other):
-        return (super().__eq__(other)
-                and isinstance(other, RowChecker) and other.row_index == self.row_index)
+    def get_range(self) -> str:
+        return f"{self.row_index}:{self.row_index}"
 
-    def get_data(self, wh: gspread.Worksheet):
-        return wh.row_values(self.row_index)
+    def get_data(self, values: List[List[str]]):
+        return values[0] if values else []
 
     def get_news(self, new_data: List) -> None:
+        self.changes = [Change(self.row_index, i + 1, old, new)
+                        for i, old, new in diff_cells(self.data, new_data)]
         self.answer = ''
         if len(new_data) != len(self.data):
-            self.answer += (f"Изменен размер строки {self.row_index} с {len(self.data)}" +
-                            f" на {len(new_data)}\n")
-        col_index = 1
-        for i, j in zip(self.data, new_data):
-            if i != j:
-                self.answer += (f"Изменена ячейка с координатами ({self.row_index}, {col_index}) "
-                                + f"c {i} на {j}\n")
-            col_index += 1
+            self.answer = (f"Изменен размер строки {self.row_index} с {len(self.data)}"
+                           f" на {len(new_data)}\n")
+        self.answer += render(self.changes)
 
 
 class ColChecker(BaseChecker):
     col_index: int
+    major_dimension = "COLUMNS"
 
     def __init__(self, ref: str, worksheet: int, col_index: int):
         super().__init__(ref, worksheet)
         self.col_index = col_index
-        self.update()
 
-    def __eq__(self, other):
-        return (super().__eq__(other)
-                and isinstance(other, ColChecker) and self.col_index == other.col_index)
+    def get_range(self) -> str:
+        letter = rowcol_to_a1(1, self.col_index)[:-1]
+        return f"{letter}:{letter}"
 
-    def get_data(self, wh: gspread.Worksheet):
-        return wh.col_values(self.col_index)
+    def get_data(self, values: List[List[str]]):
+        return values[0] if values else []
 
     def get_news(self, new_data: List) -> None:
+        # Rows are not aligned here, a single value is no fingerprint of its row
+        self.changes = [Change(i + 1, self.col_index, old, new)
+                        for i, old, new in diff_cells(self.data, new_data)]
         self.answer = ''
         if len(new_data) != len(self.data):
-            self.answer += (f"Изменен размер столбца {self.col_index} с {len(self.data)}" +
-                            f" на {len(new_data)}\n")
-        row_index = 1
-        for i, j in zip(self.data, new_data):
-            if i != j:
-                self.answer += (f"Изменена ячейка с координатами ({self.col_index}, {row_index}) "
-                                + f"c {i} на {j}\n")
-            row_index += 1
+            self.answer = (f"Изменен размер столбца {self.col_index} с {len(self.data)}"
+                           f" на {len(new_data)}\n")
+        self.answer += render(self.changes)
 
 
 class SheetChecker(BaseChecker):
+    data: Snapshot
+
     def __init__(self, ref: str, worksheet: int):
         super().__init__(ref, worksheet)
-        self.update()
+        self.data = Snapshot.empty()
 
-    def __eq__(self, other):
-        return super().__eq__(other) and isinstance(other, SheetChecker)
+    def get_range(self) -> str:
+        return ''
 
-    def get_data(self, wh: gspread.Worksheet):
-        return wh.get_all_values()
+    def dump_data(self):
+        return self.data.rows()
 
-    def get_news(self, new_data: List) -> None:
+    def restore(self, data, version: Optional[str]) -> None:
+        super().restore(snapshots.put((self.spreadsheet_id, self.worksheet_index), data), version)
+
+    def release(self) -> None:
+        snapshots.discard((self.spreadsheet_id, self.worksheet_index))
+
+    def get_data(self, values: List[List[str]]):
+        # Checkers of one worksheet share the stored snapshot instead of keeping own copies
+        return snapshots.put((self.spreadsheet_id, self.worksheet_index), values)
+
+    def get_news(self, new_data: Snapshot) -> None:
+        events = []
+        if ALIGN_ROWS:
+            events, self.changes = diff_snapshots_aligned(self.data, new_data)
+        else:
+            self.changes = diff_snapshots(self.data, new_data)
         self.answer = ''
-        if len(new_data) != len(self.data):
-            self.answer += (f"Изменен размер таблицы по вертикали с {len(self.data)}" +
-                            f" на {len(new_data)}\n")
-        if new_data and self.data and len(new_data[0]) != len(self.data[0]):
-            self.answer += (f"Изменен размер таблицы по горизонтали с {len(self.data)}" +
-                            f" на {len(new_data)}\n")
-        row_index = col_index = 1
-        for row_1, row_2 in zip(self.data, new_data):
-            for i, j in zip(row_1, row_2):
-                if i != j:
-                    self.answer += (f"Изменена ячейка с координатами ({col_index}, {row_index}) "
-                                    + f"c {i} на {j}\n")
-                col_index += 1
-            row_index += 1
+        if new_data.height != self.data.height:
+            self.answer += (f"Изменен размер таблицы по вертикали с {self.data.height}"
+                            f" на {new_data.height}\n")
+        if new_data.width != self.data.width:
+            self.answer += (f"Изменен размер таблицы по горизонтали с {self.data.width}"
+                            f" на {new_data.width}\n")
+        self.answer += render_events(events) + render(self.changes)
+
+
+class RangeChecker(BaseChecker):
+    """Watches one or several A1 ranges, only their cells are fetched"""
+    ranges: List[str]
+    data: List[List[List[str]]]
+
+    def __init__(self, ref: str, worksheet: int, ranges: List[str]):
+        super().__init__(ref, worksheet)
+        self.ranges = ranges
+        self.data = [[] for _ in ranges]
+
+    @classmethod
+    def parse(cls, text: str) -> List[str]:
+        """:returns ranges written with commas or spaces between them, like "B2:K40, M1:M5"
+        :raise ValueError if one of them is not an A1 range
+        """
+        ranges = [part for part in re.split(r"[\s,;]+", text.upper()) if part]
+        for name in ranges:
+            match = A1_RANGE.fullmatch(name)
+            if (match is None or not any(match.group(1, 2))
+                    or (":" in name and not any(match.group(3, 4)))
+                    or (":" not in name and not all(match.group(1, 2)))):
+                raise ValueError(f"Not an A1 range: {name}")
+        if not ranges:
+            raise ValueError("No ranges")
+        return ranges
+
+    def get_range(self) -> str:
+        return ",".join(self.ranges)
+
+    def get_ranges(self) -> List[str]:
+        return self.ranges
+
+    def get_data(self, *grids: List[List[str]]):
+        return list(grids)
+
+    def get_news(self, new_data: List[List[List[str]]]) -> None:
+        self.changes = []
+        for name, old, new in zip(self.ranges, self.data, new_data):
+            row, col = range_start(name)
+            # Values start at the top left cell of the requested range
+            self.changes.extend(Change(change.row + row - 1, change.col + col - 1, change.old,
+                                       change.new) for change in diff_grids(old, new))
+        self.answer = render(self.changes)
@@ -0,0 +1,52 @@
+"""Google clients. Key files are read and tokens requested only when an account makes its
+first request, so importing the bot needs neither the keys nor the network
+"""
+import datetime
+import threading
+
+import gspread
+import requests
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+
+from config import HTTP_GZIP, HTTP_POOL_SIZE, TOKEN_REFRESH_MARGIN
+
+
+class KeepAliveSession(AuthorizedSession):
+    """Authorized session whose connection pool fits all poll threads, so connections stay
+    alive between polls instead of a TLS handshake per request. The token is refreshed by
+    one thread before it expires rather than by requests that find it expired
+    """
+
+    def __init__(self, credentials: Credentials, pool_size: int = HTTP_POOL_SIZE,
+                 gzip: bool = HTTP_GZIP, margin: float = TOKEN_REFRESH_MARGIN):
+        super().__init__(credentials)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.margin = datetime.timedelta(seconds=margin)
+        self.refresh_lock = threading.Lock()
+        # Token requests go through their own session, not through this one
+        self.token_request = Request(requests.Session())
+        if gzip:
+            # Google compresses responses for clients with gzip in the user agent
+            self.headers["Accept-Encoding"] = "gzip"
+            self.headers["User-Agent"] = f"{self.headers.get('User-Agent', 'python')} (gzip)"
+
+    def fresh(self) -> bool:
+        credentials = self.credentials
+        return (credentials.token is not None and credentials.expiry is not None
+                and credentials.expiry - datetime.datetime.utcnow() > self.margin)
+
+    def request(self, method, url, *args, **kwargs):
+        if not self.fresh():
+            with self.refresh_lock:
+                if not self.fresh():
+                    self.credentials.refresh(self.token_request)
+        return super().request(method, url, *args, **kwargs)
+
+
+def make_client(filename: str) -> gspread.Client:
+    credentials = Credentials.from_service_account_file(filename,
+                                                        scopes=gspread.auth.DEFAULT_SCOPES)
+    return gspread.Client(auth=credentials, session=KeepAliveSession(credentials))
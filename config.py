@@ -0,0 +1,106 @@
+"""Tunables of the bot. Every value can be overridden by an environment variable"""
+import os
+
+# Threads doing blocking Google API calls, i.e. how many spreadsheets are fetched at once
+POLL_WORKERS = int(os.environ.get("POLL_WORKERS", 8))
+# Threads doing Google API calls of commands, like checking a new table, apart from the polls
+COMMAND_WORKERS = int(os.environ.get("COMMAND_WORKERS", 4))
+# Time between two polls of a table that has just changed, seconds
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", 60))
+# Every poll without changes makes the interval this many times longer, up to the ceiling
+POLL_BACKOFF = float(os.environ.get("POLL_BACKOFF", 2))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", 3600))
+# Shortest interval an owner may pin with /set_interval, seconds. The quota is shared by all
+# chats, so a single table polled every second would starve the others
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", POLL_INTERVAL))
+# How often the scheduler looks for due tables, seconds
+POLL_TICK = float(os.environ.get("POLL_TICK", 1))
+# Random deviation of every poll from its exact time, as a share of the interval
+POLL_JITTER = float(os.environ.get("POLL_JITTER", 0.1))
+# Opened spreadsheets and their worksheet lists are reused for this long, seconds
+HANDLE_TTL = float(os.environ.get("HANDLE_TTL", 300))
+# At most this many spreadsheets are kept opened, the least recently used go first
+HANDLE_CACHE_SIZE = int(os.environ.get("HANDLE_CACHE_SIZE", 1024))
+# Ask Drive for the spreadsheet version before downloading values and skip unchanged ones.
+# Values recalculated without an edit (NOW, IMPORTRANGE, ...) don't change the version
+CHANGE_DETECTION = os.environ.get("CHANGE_DETECTION", "1") == "1"
+# Align old and new rows of sheet checkers by their contents, so inserted,
+# deleted and moved rows are reported once instead of every shifted cell
+ALIGN_ROWS = os.environ.get("ALIGN_ROWS", "1") == "1"
+# Resident memory for sheet snapshots, bytes. Over it the coldest snapshots are spilled to disk
+SNAPSHOT_MEMORY = int(os.environ.get("SNAPSHOT_MEMORY", 256 * 2 ** 20))
+# Directory for spilled snapshots, spilling is off when empty
+SNAPSHOT_SPILL_DIR = os.environ.get("SNAPSHOT_SPILL_DIR", "")
+# SQLite database with subscriptions
+DATABASE = os.environ.get("DATABASE", "base.sqlite3")
+# Old JSON base, imported into an empty database once
+BASE_JSON = os.environ.get("BASE_JSON", "base.json")
+# How often changed tables are written to the database, seconds
+DUMP_INTERVAL = float(os.environ.get("DUMP_INTERVAL", 10))
+# Telegram flood limits: messages per second to one chat and to all chats together
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", 1))
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", 30))
+# Notifications to one chat during this many seconds are merged into one message
+SEND_COALESCE_WINDOW = float(os.environ.get("SEND_COALESCE_WINDOW", 2))
+# How often the outgoing queue is drained, seconds
+SEND_TICK = float(os.environ.get("SEND_TICK", 0.2))
+# Local HTTP endpoint with /metrics, off when the port is 0
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# Service account key files separated by commas, spreadsheets are spread over all of them
+SERVICE_ACCOUNT_FILES = os.environ.get(
+    "SERVICE_ACCOUNT_FILES", "my-python-project-394918-c67628393454.json").split(",")
+# Sheets read requests allowed per minute for one service account
+QUOTA_READS_PER_MINUTE = float(os.environ.get("QUOTA_READS_PER_MINUTE", 60))
+# Reads of an account that polls leave free for commands. A poll starts only when the account
+# has a read free beyond them, otherwise its tables are polled on a later tick
+QUOTA_COMMAND_RESERVE = float(os.environ.get("QUOTA_COMMAND_RESERVE", 5))
+# Attempts of a request failed with 429 or 5xx and the backoff before them, seconds
+API_RETRIES = int(os.environ.get("API_RETRIES", 4))
+API_BACKOFF = float(os.environ.get("API_BACKOFF", 1))
+API_BACKOFF_CAP = float(os.environ.get("API_BACKOFF_CAP", 32))
+# After this many failed polls in a row a spreadsheet rests for the cooldown, which doubles
+# after every next failure up to the ceiling, seconds
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", 3))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 300))
+BREAKER_MAX_COOLDOWN = float(os.environ.get("BREAKER_MAX_COOLDOWN", 3600))
+# Poller worker processes, each owning a shard of spreadsheets. With 0 the bot polls itself.
+# SIGUSR1 to the bot adds a worker and SIGUSR2 retires one
+POLLER_SHARDS = int(os.environ.get("POLLER_SHARDS", 0))
+# Public HTTPS URL Telegram posts updates to, empty means long polling. The local server
+# listens on the URL's path without TLS, a proxy in front of it terminates TLS
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+# Telegram sends it with every update. Instances behind one URL must share it, empty means a
+# random one on every start
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Connections Telegram may open to the webhook at once
+WEBHOOK_CONNECTIONS = int(os.environ.get("WEBHOOK_CONNECTIONS", 40))
+# Updates handled at once, updates of one chat still go one by one
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))
+# Kept-alive HTTPS connections to Google of one account, more poll threads than this would
+# open new connections
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", max(POLL_WORKERS + COMMAND_WORKERS, 10)))
+# Ask Google for gzip-compressed responses
+HTTP_GZIP = os.environ.get("HTTP_GZIP", "1") == "1"
+# OAuth tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = float(os.environ.get("TOKEN_REFRESH_MARGIN", 300))
+# Public HTTPS URL Drive posts change notifications to, empty means polling only. Spreadsheets
+# with a live channel are polled when they change, the others on schedule. The local server
+# listens on the URL's path without TLS, like the webhook. Not used with poller shards
+PUSH_URL = os.environ.get("PUSH_URL", "")
+PUSH_HOST = os.environ.get("PUSH_HOST", "0.0.0.0")
+PUSH_PORT = int(os.environ.get("PUSH_PORT", 8081))
+# Drive sends it with every notification, empty means a random one on every start
+PUSH_SECRET = os.environ.get("PUSH_SECRET", "")
+# Lifetime asked for a channel, Drive gives at most a day to channels of files, seconds
+PUSH_TTL = float(os.environ.get("PUSH_TTL", 86400))
+# Channels are renewed this many seconds before they expire
+PUSH_RENEW_MARGIN = float(os.environ.get("PUSH_RENEW_MARGIN", 600))
+# How often channels are opened, renewed and closed, seconds, and at most how many each time,
+# so opening channels of every spreadsheet doesn't hold up polls and commands
+PUSH_TICK = float(os.environ.get("PUSH_TICK", 30))
+PUSH_BATCH = int(os.environ.get("PUSH_BATCH", 50))
+# A spreadsheet is polled this many seconds after a notification, a burst of edits is one poll
+PUSH_DELAY = float(os.environ.get("PUSH_DELAY", 1))
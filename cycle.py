@@ -0,0 +1,109 @@
+"""Poll cycle of due tables, the same in the bot process, the poller workers and the benchmark"""
+import asyncio
+import logging
+from concurrent.futures import Executor
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from config import POLL_TICK
+from fetcher import FetchPlanner
+from metrics import FAN_OUT, POLL_CYCLE
+from scheduler import AdaptivePolicy, PollScheduler
+from subscriptions import SubscriptionIndex
+
+# (chat_id, table name), the key tables subscribe to their checkers by
+TableKey = Tuple[str, str]
+
+
+class PollCycle:
+    """Polls tables with one values request per spreadsheet. Spreadsheets are admitted on their
+    accounts' quotas first, then polled in the executor. Changed checker data is saved, the news
+    of a checker go to every table sharing it, due or not, and the polled tables' intervals adapt
+    """
+
+    def __init__(self, planner: FetchPlanner, subscriptions: SubscriptionIndex,
+                 policy: AdaptivePolicy, scheduler: PollScheduler, executor: Executor,
+                 resolve: Callable[[Hashable], Tuple[TableKey, object]],
+                 notify: Callable[[TableKey, str], None], save: Callable[[object], None],
+                 polling: Optional[set] = None):
+        """:param resolve gives the subscription key and the table of a scheduler item
+        :param notify sends the news of a table by its subscription key
+        :param save takes a checker whose data has changed
+        :param polling scheduler items and checkers whose poll has started but not finished yet,
+        shared with the caller"""
+        self.planner = planner
+        self.subscriptions = subscriptions
+        self.policy = policy
+        self.scheduler = scheduler
+        self.executor = executor
+        self.resolve = resolve
+        self.notify = notify
+        self.save = save
+        self.polling = set() if polling is None else polling
+
+    def defer(self, item: Hashable) -> None:
+        self.scheduler.postpone(item, POLL_TICK)
+
+    def admit(self, items: List[Hashable],
+              defer: Callable[[Hashable], None]) -> Dict[Hashable, Tuple[TableKey, object]]:
+        """Takes the reads of every spreadsheet of the items. Items of spreadsheets whose
+        accounts have no reads free for polls are deferred, so poll threads don't wait for
+        the quota
+        :returns the admitted items with their keys and tables"""
+        admitted, tables = {}, {}
+        for item in items:
+            key, table = self.resolve(item)
+            if table.spreadsheet_id not in admitted:
+                admitted[table.spreadsheet_id] = self.planner.admit(table.spreadsheet_id)
+            if admitted[table.spreadsheet_id]:
+                tables[item] = key, table
+            else:
+                self.polling.discard(item)
+                defer(item)
+        return tables
+
+    async def poll(self, items: List[Hashable],
+                   defer: Optional[Callable[[Hashable], None]] = None) -> Set[TableKey]:
+        """:param defer takes the items that weren't admitted, postponed for a tick by default
+        :returns keys of the tables with news"""
+        tables = self.admit(items, self.defer if defer is None else defer)
+        # A shared checker may be in the poll of another table already
+        checkers = [checker for checker in dict.fromkeys(checker for _, table in tables.values()
+                                                         for checker in table.checkers)
+                    if checker not in self.polling]
+        self.polling.update(checkers)
+        try:
+            with POLL_CYCLE.time():
+                groups = self.planner.group(checkers)
+                # Spreadsheets whose checkers are all polled elsewhere
+                for key in {table.spreadsheet_id for _, table in tables.values()} - groups.keys():
+                    self.planner.release(key)
+                loop = asyncio.get_running_loop()
+                results = await asyncio.gather(
+                    *(loop.run_in_executor(self.executor, self.planner.poll_spreadsheet, key,
+                                           group) for key, group in groups.items()),
+                    return_exceptions=True)
+            # Checkers fed before an unexpected error have news and new versions all the same
+            for key, result in zip(groups, results):
+                if isinstance(result, Exception):
+                    logging.error("Can't poll spreadsheet %s", key, exc_info=result)
+            # A shared checker's data is saved once, whatever number of tables watch it
+            for checker in checkers:
+                if checker.dirty:
+                    self.save(checker)
+            changed = set()
+            with FAN_OUT.time():
+                for key, polled in self.subscriptions.fan_out(checkers).items():
+                    news = ''.join(checker.answer for checker in polled)
+                    if news:
+                        changed.add(key)
+                        self.notify(key, news)
+            for item, (key, table) in tables.items():
+                interval = self.policy.after_poll(table.interval, key in changed,
+                                                  table.min_interval, table.max_interval)
+                if interval != table.interval and item in self.scheduler:
+                    table.interval = interval
+                    self.scheduler.reschedule(item, interval)
+            return changed
+        finally:
+            self.polling.difference_update(items)
+            self.polling.difference_update(checkers)
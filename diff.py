@@ -0,0 +1,264 @@
+from bisect import bisect_left
+from collections import Counter
+from difflib import SequenceMatcher
+from itertools import zip_longest
+from typing import Dict, Hashable, List, NamedTuple, Optional, Sequence, Tuple
+
+from gspread.utils import rowcol_to_a1
+
+# Largest gap without unique rows, as old rows times new rows, that is aligned by
+# SequenceMatcher. Bigger ones are left unmatched
+ALIGN_GAP_LIMIT = 10 ** 6
+
+
+class Change(NamedTuple):
+    """Changed cell, coordinates start from 1"""
+    row: int
+    col: int
+    old: Optional[str]
+    new: Optional[str]
+
+
+class RowEvent(NamedTuple):
+    """Rows inserted, deleted or moved as a whole, numbers start from 1 and are 0 for the
+    side the rows are missing from"""
+    kind: str
+    old: int
+    new: int
+    count: int
+
+
+def diff_cells(old: Sequence[str], new: Sequence[str]) -> List[Tuple[int, str, str]]:
+    """:returns (position from 0, old, new) of the differing cells, the shorter sequence is
+    padded with empty strings"""
+    if old == new:
+        return []
+    return [(i, a, b) for i, (a, b) in enumerate(zip_longest(old, new, fillvalue='')) if a != b]
+
+
+def diff_grids(old: Sequence[Sequence[str]], new: Sequence[Sequence[str]]) -> List[Change]:
+    """Grids may be ragged and of different shapes, missing cells count as empty.
+    Equal rows are compared as a whole and skipped without looking at their cells"""
+    changes = []
+    for row, (old_row, new_row) in enumerate(zip_longest(old, new, fillvalue=()), 1):
+        if old_row != new_row:
+            changes.extend(Change(row, i + 1, a, b) for i, a, b in diff_cells(old_row, new_row))
+    return changes
+
+
+def diff_snapshots(old, new) -> List[Change]:
+    """Same as diff_grids for snapshots. When both use one string table, rows are compared
+    by their codes and only the differing ones are decoded"""
+    if old.table_id != new.table_id:
+        return diff_grids(old, new)
+    changes = []
+    for row in range(max(old.height, new.height)):
+        if row < old.height and row < new.height and old.width == new.width:
+            if old.row_codes(row) == new.row_codes(row):
+                continue
+        old_row = old.row(row) if row < old.height else []
+        new_row = new.row(row) if row < new.height else []
+        changes.extend(Change(row + 1, i + 1, a, b) for i, a, b in diff_cells(old_row, new_row))
+    return changes
+
+
+def render(changes: List[Change]) -> str:
+    return ''.join(f"Изменена ячейка {rowcol_to_a1(change.row, change.col)} "
+                   f"с {change.old} на {change.new}\n" for change in changes)
+
+
+def _unique_matches(old: Sequence[Hashable], new: Sequence[Hashable], old_start: int,
+                    old_stop: int, new_start: int, new_stop: int) -> List[Tuple[int, int]]:
+    """Longest increasing run of the keys that occur once on both sides, the anchors of
+    patience diff"""
+    old_counts = Counter(old[old_start:old_stop])
+    new_positions: Dict[Hashable, int] = {}
+    new_counts = Counter()
+    for j in range(new_start, new_stop):
+        new_counts[new[j]] += 1
+        new_positions[new[j]] = j
+    pairs = [(i, new_positions[old[i]]) for i in range(old_start, old_stop)
+             if old_counts[old[i]] == 1 and new_counts[old[i]] == 1]
+    # Patience sorting finds the longest run increasing on the new side
+    tails: List[int] = []
+    tail_indices: List[int] = []
+    previous: List[int] = []
+    for index, (_, j) in enumerate(pairs):
+        position = bisect_left(tails, j)
+        if position == len(tails):
+            tails.append(j)
+            tail_indices.append(index)
+        else:
+            tails[position] = j
+            tail_indices[position] = index
+        previous.append(tail_indices[position - 1] if position else -1)
+    run = []
+    index = tail_indices[-1] if tail_indices else -1
+    while index != -1:
+        run.append(pairs[index])
+        index = previous[index]
+    return run[::-1]
+
+
+def align(old: Sequence[Hashable], new: Sequence[Hashable]) -> List[Tuple[int, int]]:
+    """Patience alignment of two key sequences.
+    :returns pairs of (old index, new index) of matched keys, increasing on both sides"""
+    matches = []
+    stack = [(0, len(old), 0, len(new))]
+    while stack:
+        old_start, old_stop, new_start, new_stop = stack.pop()
+        while old_start < old_stop and new_start < new_stop and old[old_start] == new[new_start]:
+            matches.append((old_start, new_start))
+            old_start += 1
+            new_start += 1
+        while old_start < old_stop and new_start < new_stop and \
+                old[old_stop - 1] == new[new_stop - 1]:
+            old_stop -= 1
+            new_stop -= 1
+            matches.append((old_stop, new_stop))
+        if old_start == old_stop or new_start == new_stop:
+            continue
+        anchors = _unique_matches(old, new, old_start, old_stop, new_start, new_stop)
+        if not anchors:
+            # Only repeated rows are left, a small gap is matched by the longest common blocks
+            if (old_stop - old_start) * (new_stop - new_start) <= ALIGN_GAP_LIMIT:
+                matcher = SequenceMatcher(None, old[old_start:old_stop], new[new_start:new_stop],
+                                          autojunk=False)
+                for i, j, size in matcher.get_matching_blocks():
+                    matches.extend((old_start + i + k, new_start + j + k) for k in range(size))
+            continue
+        for i, j in anchors:
+            stack.append((old_start, i, new_start, j))
+            matches.append((i, j))
+            old_start, new_start = i + 1, j + 1
+        stack.append((old_start, old_stop, new_start, new_stop))
+    matches.sort()
+    return matches
+
+
+def _runs(kind: str, rows: List[Tuple[int, int]]) -> List[RowEvent]:
+    """Merges consecutive (old, new) rows into events, -1 is a missing side"""
+    events = []
+    for i, j in rows:
+        if events:
+            last = events[-1]
+            if (not last.old or last.old + last.count == i + 1) and \
+                    (not last.new or last.new + last.count == j + 1):
+                events[-1] = last._replace(count=last.count + 1)
+                continue
+        events.append(RowEvent(kind, i + 1, j + 1, 1))
+    return events
+
+
+def align_rows(old: Sequence[Hashable], new: Sequence[Hashable]) \
+        -> Tuple[List[RowEvent], List[Tuple[int, int]]]:
+    """Aligns rows by their keys. Rows that are gone from one place and equal ones that have
+    appeared at another are a move. The other unmatched rows between two matched ones are
+    paired in order as changed rows, and the rest are inserts and deletes
+    :returns row events and (old index, new index) of the changed rows to diff by cells
+    """
+    if old == new:
+        return [], []
+    edited = _edited_in_place(old, new)
+    if edited is not None:
+        return [], [(i, i) for i in edited]
+    matches = align(old, new)
+    matched_old = {i for i, _ in matches}
+    matched_new = {j for _, j in matches}
+    appeared: Dict[Hashable, List[int]] = {}
+    for j in range(len(new)):
+        if j not in matched_new:
+            appeared.setdefault(new[j], []).append(j)
+    moves = []
+    for i in range(len(old)):
+        if i not in matched_old and appeared.get(old[i]):
+            j = appeared[old[i]].pop(0)
+            moves.append((i, j))
+            matched_old.add(i)
+            matched_new.add(j)
+    changed, deleted, inserted = [], [], []
+    old_start, new_start = -1, -1
+    for old_stop, new_stop in matches + [(len(old), len(new))]:
+        if old_stop - old_start > 1 or new_stop - new_start > 1:
+            gone = [i for i in range(old_start + 1, old_stop) if i not in matched_old]
+            came = [j for j in range(new_start + 1, new_stop) if j not in matched_new]
+            changed.extend(zip(gone, came))
+            deleted.extend((i, -1) for i in gone[len(came):])
+            inserted.extend((-1, j) for j in came[len(gone):])
+        old_start, new_start = old_stop, new_stop
+    events = _runs("delete", deleted) + _runs("insert", inserted) + _runs("move", moves)
+    return events, changed
+
+
+def _edited_in_place(old: Sequence[Hashable], new: Sequence[Hashable]) -> Optional[List[int]]:
+    """Rows of equal counts that differ at the same places are edited there, as long as none
+    of the old keys of those rows is among their new ones, so nothing could have moved.
+    Aligning would pair them the same way at a much higher cost
+    :returns indices of the edited rows, None if rows may have moved"""
+    if len(old) != len(new):
+        return None
+    edited = [i for i, (a, b) in enumerate(zip(old, new)) if a != b]
+    if {old[i] for i in edited}.isdisjoint(new[i] for i in edited):
+        return edited
+    return None
+
+
+def snapshot_keys(old, new) -> Tuple[List[Hashable], List[Hashable]]:
+    """Row keys of two snapshots. With one string table and width rows are keyed by their
+    codes and nothing is decoded, otherwise by the cells without trailing empty ones"""
+    if old.table_id == new.table_id and old.width == new.width:
+        step = 4 * old.width
+        old_codes, new_codes = old.codes.tobytes(), new.codes.tobytes()
+        return ([old_codes[row * step:(row + 1) * step] for row in range(old.height)],
+                [new_codes[row * step:(row + 1) * step] for row in range(new.height)])
+    return [_row_key(row) for row in old], [_row_key(row) for row in new]
+
+
+def _row_key(row: Sequence[str]) -> tuple:
+    end = len(row)
+    while end and row[end - 1] == '':
+        end -= 1
+    return tuple(row[:end])
+
+
+def diff_snapshots_aligned(old, new) -> Tuple[List[RowEvent], List[Change]]:
+    """Same as diff_snapshots with rows aligned by align_rows. Cells are compared only in the
+    changed rows, their changes are labelled with the new positions"""
+    if old is new:
+        return [], []
+    events, changed = align_rows(*snapshot_keys(old, new))
+    changes = []
+    for i, j in changed:
+        changes.extend(Change(j + 1, c + 1, a, b)
+                       for c, a, b in diff_cells(old.row(i), new.row(j)))
+    # The API leaves out trailing empty rows, so rows gone from the end may have been cleared
+    # rather than deleted. Their old cells are reported as changed to empty
+    tail = [event for event in events
+            if event.kind == "delete" and event.old + event.count - 1 == old.height]
+    for event in tail:
+        events.remove(event)
+        for k in range(event.count):
+            changes.extend(Change(new.height + k + 1, c + 1, a, b)
+                           for c, a, b in diff_cells(old.row(event.old - 1 + k), []))
+    return events, changes
+
+
+def render_events(events: List[RowEvent]) -> str:
+    lines = []
+    for event in events:
+        last = event.count - 1
+        match event.kind, event.count:
+            case "insert", 1:
+                lines.append(f"Добавлена строка {event.new}\n")
+            case "insert", _:
+                lines.append(f"Добавлены строки {event.new}-{event.new + last}\n")
+            case "delete", 1:
+                lines.append(f"Удалена строка {event.old}\n")
+            case "delete", _:
+                lines.append(f"Удалены строки {event.old}-{event.old + last}\n")
+            case "move", 1:
+                lines.append(f"Строка {event.old} перемещена на место {event.new}\n")
+            case "move", _:
+                lines.append(f"Строки {event.old}-{event.old + last} перемещены на место"
+                             f" {event.new}-{event.new + last}\n")
+    return ''.join(lines)
@@ -0,0 +1,141 @@
+import datetime
+import logging
+import time
+from collections import deque, OrderedDict
+from typing import Deque, Dict, List, Optional, Set, Union
+
+from telegram import Bot
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import ContextTypes
+
+from config import SEND_CHAT_RATE, SEND_COALESCE_WINDOW, SEND_GLOBAL_RATE
+from metrics import SEND, SEND_ERRORS
+
+ChatId = Union[int, str]
+
+
+class TokenBucket:
+    rate: float
+    capacity: float
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = max(1.0, rate) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def ready(self, now: float) -> bool:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+def split_message(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> List[str]:
+    """Splits text into messages at line ends, a line longer than the limit is cut"""
+    parts = []
+    current = ''
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ''
+        current += line
+    if current:
+        parts.append(current)
+    return parts
+
+
+class Dispatcher:
+    """Queue of outgoing notifications. Texts to one chat within the coalesce window become
+    one message, long messages are split, and sending respects per chat and global rates.
+    Messages of one chat are sent one at a time and in order
+    """
+    window: float
+
+    def __init__(self, chat_rate: float = SEND_CHAT_RATE, global_rate: float = SEND_GLOBAL_RATE,
+                 window: float = SEND_COALESCE_WINDOW):
+        self.chat_rate = chat_rate
+        self.window = window
+        self.bucket = TokenBucket(global_rate)
+        self.chat_buckets: Dict[ChatId, TokenBucket] = {}
+        # Texts waiting for their coalesce window to end and when the first of them came
+        self.pending: Dict[ChatId, List[str]] = {}
+        self.pending_since: Dict[ChatId, float] = {}
+        # Ready messages by chat
+        self.outbox: OrderedDict[ChatId, Deque[str]] = OrderedDict()
+        self.sending: Set[ChatId] = set()
+        self.paused_until = 0.0
+
+    @property
+    def backlog(self) -> int:
+        return sum(map(len, self.pending.values())) + sum(map(len, self.outbox.values()))
+
+    def send(self, chat_id: ChatId, text: str) -> None:
+        if chat_id not in self.pending:
+            self.pending[chat_id] = []
+            self.pending_since[chat_id] = time.monotonic()
+        self.pending[chat_id].append(text)
+
+    async def flush(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Job that starts sending everything the limits allow right now"""
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, since in self.pending_since.items()
+                        if now - since >= self.window]:
+            del self.pending_since[chat_id]
+            text = '\n'.join(self.pending.pop(chat_id))
+            self.outbox.setdefault(chat_id, deque()).extend(split_message(text))
+        if now < self.paused_until:
+            return
+        for chat_id in list(self.outbox):
+            if not self.bucket.ready(now):
+                break
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate))
+            if chat_id in self.sending or not bucket.ready(now):
+                continue
+            self.bucket.take()
+            bucket.take()
+            text = self.outbox[chat_id].popleft()
+            if not self.outbox[chat_id]:
+                del self.outbox[chat_id]
+            self.sending.add(chat_id)
+            context.application.create_task(self.deliver(context.bot, chat_id, text))
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items()
+                        if chat_id not in self.outbox and bucket.ready(now)
+                        and bucket.tokens >= bucket.capacity]:
+            del self.chat_buckets[chat_id]
+
+    async def deliver(self, bot: Bot, chat_id: ChatId, text: str) -> None:
+        try:
+            with SEND.time():
+                await bot.send_message(chat_id, text)
+        except RetryAfter as e:
+            SEND_ERRORS.inc(reason="retry_after")
+            retry_after = e.retry_after
+            if isinstance(retry_after, datetime.timedelta):
+                retry_after = retry_after.total_seconds()
+            logging.warning("Flood limit, sending is paused for %s seconds", retry_after)
+            self.paused_until = time.monotonic() + retry_after
+            self.requeue(chat_id, text)
+        except (BadRequest, Forbidden):
+            SEND_ERRORS.inc(reason="rejected")
+            # The chat is gone or the bot is blocked there, repeating won't help
+            logging.exception("Can't send a message to %s", chat_id)
+        except NetworkError:
+            SEND_ERRORS.inc(reason="network")
+            logging.warning("Network error while sending to %s, will retry", chat_id)
+            self.requeue(chat_id, text)
+        finally:
+            self.sending.discard(chat_id)
+
+    def requeue(self, chat_id: ChatId, text: str) -> None:
+        self.outbox.setdefault(chat_id, deque()).appendleft(text)
+        self.outbox.move_to_end(chat_id, last=False)
@@ -0,0 +1,228 @@
+"""In-process stand-in of the Sheets and Drive APIs for benchmarks and load tests.
+It implements only the calls the fetch layer and the push channels make, and posts Drive
+notifications of the changes it makes to the watching channels
+"""
+import logging
+import random
+import re
+import threading
+import time
+import urllib.request
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import gspread
+from gspread.utils import a1_to_rowcol
+
+_RANGE = re.compile(r"^([A-Za-z]*)(\d*)$")
+
+
+def parse_range(name: str) -> Tuple[str, Optional[str]]:
+    """:returns worksheet title and A1 range of "'Title'!A1:B2", range is None for a whole sheet"""
+    if name.startswith("'"):
+        end = name.index("'!") if "'!" in name else len(name) - 1
+        title, rest = name[1:end].replace("''", "'"), name[end + 2:]
+    else:
+        title, _, rest = name.partition("!")
+    return title, rest or None
+
+
+def grid_bounds(a1: Optional[str], height: int, width: int) -> Tuple[int, int, int, int]:
+    """:returns first row, first column, last row, last column of A1 range, from 1"""
+    if a1 is None:
+        return 1, 1, height, width
+    start, _, end = a1.partition(":")
+    end = end or start
+    bounds = []
+    for part, default_row, default_col in ((start, 1, 1), (end, height, width)):
+        letters, digits = _RANGE.match(part).groups()
+        col = a1_to_rowcol(f"{letters}1")[1] if letters else default_col
+        row = int(digits) if digits else default_row
+        bounds.append((row, col))
+    return bounds[0][0], bounds[0][1], bounds[1][0], bounds[1][1]
+
+
+def _trim(row: List[str]) -> List[str]:
+    end = len(row)
+    while end and row[end - 1] == '':
+        end -= 1
+    return row[:end]
+
+
+class FakeResponse:
+    def __init__(self, data: dict):
+        self.data = data
+
+    def json(self) -> dict:
+        return self.data
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet: "FakeSpreadsheet", title: str, index: int):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.index = index
+        self.id = index
+        self.grid: List[List[str]] = []
+        # Grid sizes of a fetched worksheet, None for the live one
+        self.size: Optional[Tuple[int, int]] = None
+
+    @property
+    def row_count(self) -> int:
+        return len(self.grid) if self.size is None else self.size[0]
+
+    @property
+    def col_count(self) -> int:
+        return max(map(len, self.grid), default=0) if self.size is None else self.size[1]
+
+    def fetched(self) -> "FakeWorksheet":
+        """:returns a copy with the sizes of now, like gspread's worksheet that doesn't see
+        later changes of the grid"""
+        sheet = FakeWorksheet(self.spreadsheet, self.title, self.index)
+        sheet.grid = self.grid
+        sheet.size = self.row_count, self.col_count
+        return sheet
+
+
+class FakeSpreadsheet:
+    def __init__(self, client: "FakeClient", key: str):
+        self.client = client
+        self.id = key
+        self.version = 1
+        self.sheets: List[FakeWorksheet] = []
+
+    def worksheets(self) -> List[FakeWorksheet]:
+        self.client.call("metadata", self.id)
+        return [sheet.fetched() for sheet in self.sheets]
+
+    def worksheet_by_title(self, title: str) -> FakeWorksheet:
+        for sheet in self.sheets:
+            if sheet.title == title:
+                return sheet
+        raise gspread.WorksheetNotFound(title)
+
+    def values_batch_get(self, ranges: List[str], params: Optional[dict] = None) -> dict:
+        self.client.call("values", self.id)
+        params = params or {}
+        value_ranges = []
+        for name in ranges:
+            title, a1 = parse_range(name)
+            grid = self.worksheet_by_title(title).grid
+            top, left, bottom, right = grid_bounds(a1, len(grid), max(map(len, grid), default=0))
+            values = [row[left - 1:right] for row in grid[top - 1:bottom]]
+            if params.get("majorDimension") == "COLUMNS":
+                values = [list(column) for column in zip(*values)]
+            # The API drops trailing empty cells and rows
+            values = [_trim(row) for row in values]
+            while values and not values[-1]:
+                values.pop()
+            value_ranges.append({"range": name, "values": values} if values else {"range": name})
+        return {"valueRanges": value_ranges}
+
+
+class FakeHttpClient:
+    """Drive requests the bot sends itself. gspread keeps them on the client's http_client,
+    so the fake does too"""
+    client: "FakeClient"
+
+    def __init__(self, client: "FakeClient"):
+        self.client = client
+
+    def request(self, method: str, endpoint: str, params: Optional[dict] = None,
+                json: Optional[dict] = None, **kwargs):
+        """Drive files.get, files.watch and channels.stop"""
+        if endpoint.endswith("/channels/stop"):
+            with self.client.lock:
+                for watches in self.client.watches.values():
+                    watches[:] = [watch for watch in watches if watch["id"] != json["id"]]
+            return FakeResponse({})
+        if endpoint.endswith("/watch"):
+            key = endpoint.rsplit("/", 2)[-2]
+            self.client.call("watch", key)
+            if key not in self.client.spreadsheets:
+                raise gspread.SpreadsheetNotFound(key)
+            watch = dict(json)
+            if self.client.channel_ttl is not None:
+                watch["expiration"] = min(watch["expiration"],
+                                          int((time.time() + self.client.channel_ttl) * 1000))
+            with self.client.lock:
+                self.client.watches.setdefault(key, []).append(watch)
+            return FakeResponse({"kind": "api#channel", "id": watch["id"],
+                                 "resourceId": f"resource-{key}",
+                                 "expiration": str(watch["expiration"])})
+        key = endpoint.rsplit("/", 1)[-1]
+        self.client.call("version", key)
+        if key not in self.client.spreadsheets:
+            raise gspread.SpreadsheetNotFound(key)
+        return FakeResponse({"version": str(self.client.spreadsheets[key].version)})
+
+
+class FakeClient:
+    """Holds spreadsheets in memory, counts calls and sleeps latency seconds on each of them"""
+    latency: float
+
+    def __init__(self, latency: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.spreadsheets: Dict[str, FakeSpreadsheet] = {}
+        self.calls: Counter = Counter()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Open channels by spreadsheet, each is the body of its files.watch request
+        self.watches: Dict[str, List[dict]] = {}
+        # Lifetime the channels get at most, seconds, a short one makes them lapse
+        self.channel_ttl: Optional[float] = None
+        self.http_client = FakeHttpClient(self)
+
+    def call(self, kind: str, key: str) -> None:
+        with self.lock:
+            self.calls[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_spreadsheet(self, key: str, worksheets: int = 1, rows: int = 100,
+                        cols: int = 10) -> FakeSpreadsheet:
+        sh = FakeSpreadsheet(self, key)
+        for index in range(worksheets):
+            sheet = FakeWorksheet(sh, f"Лист{index + 1}", index)
+            sheet.grid = [[self.value() for _ in range(cols)] for _ in range(rows)]
+            sh.sheets.append(sheet)
+        self.spreadsheets[key] = sh
+        return sh
+
+    def value(self) -> str:
+        return str(self.random.randrange(1000)) if self.random.random() < 0.8 else ''
+
+    def mutate(self, key: str, cells: int = 1) -> None:
+        """Changes random cells of the spreadsheet and bumps its version"""
+        sh = self.spreadsheets[key]
+        for _ in range(cells):
+            grid = self.random.choice(sh.sheets).grid
+            row = self.random.choice(grid)
+            row[self.random.randrange(len(row))] = self.value()
+        sh.version += 1
+        self.emit(key)
+
+    def emit(self, key: str, state: str = "update") -> None:
+        """Posts a Drive notification to every live channel of the spreadsheet"""
+        now = time.time() * 1000
+        with self.lock:
+            self.watches[key] = watches = [watch for watch in self.watches.get(key, ())
+                                           if watch["expiration"] > now]
+        for watch in watches:
+            request = urllib.request.Request(watch["address"], data=b"", method="POST", headers={
+                "X-Goog-Channel-ID": watch["id"], "X-Goog-Channel-Token": watch["token"],
+                "X-Goog-Resource-ID": f"resource-{key}", "X-Goog-Resource-State": state})
+            try:
+                urllib.request.urlopen(request, timeout=10).close()
+            except OSError:
+                logging.exception("Can't notify channel %s", watch["id"])
+
+    def open_by_key(self, key: str) -> FakeSpreadsheet:
+        self.call("metadata", key)
+        if key not in self.spreadsheets:
+            raise gspread.SpreadsheetNotFound(key)
+        return self.spreadsheets[key]
+
+    def open_by_url(self, url: str) -> FakeSpreadsheet:
+        return self.open_by_key(gspread.utils.extract_id_from_url(url))
+
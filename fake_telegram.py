@@ -0,0 +1,103 @@
+"""Local stand-in for the Telegram Bot API with just enough of getUpdates and sendMessage
+for the bot to talk to simulated users. Point the bot at it with
+Application.builder().base_url(f"http://{host}:{port}/bot")
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from httpd import Request, serve
+
+# Notifications about changed tables are not replies to commands
+NOTIFICATION = "Изменения в таблице"
+
+
+class FakeBotApi:
+    def __init__(self, token: str):
+        self.token = token
+        self.updates: List[dict] = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.arrived: Optional[asyncio.Event] = None
+        # Bot's replies by chat: time they arrived and their text
+        self.replies: Dict[int, asyncio.Queue] = {}
+        self.notifications = 0
+        self.calls = Counter()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> asyncio.AbstractServer:
+        """Serves the API on the running loop, port 0 takes a free one"""
+        self.arrived = asyncio.Event()
+        routes = {f"/bot{self.token}/{method}": getattr(self, method)
+                  for method in ("getMe", "deleteWebhook", "getUpdates", "sendMessage")}
+        return await serve(routes, host, port)
+
+    @staticmethod
+    def params(request: Request) -> dict:
+        if request.headers.get("content-type", "").startswith("application/json"):
+            return json.loads(request.body or b"{}")
+        params = {name: values[0] for name, values in request.query.items()}
+        params.update((name, values[0])
+                      for name, values in parse_qs(request.body.decode()).items())
+        return params
+
+    @staticmethod
+    def answer(result) -> Tuple[int, str, bytes]:
+        return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+    def message(self, chat_id: int, text: str, bot: bool) -> dict:
+        user = {"id": 1 if bot else chat_id, "is_bot": bot, "first_name": "bot" if bot else "user"}
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "from": user, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0,
+                                    "length": len(text.split()[0])}]
+        return message
+
+    def send_text(self, chat_id: int, text: str) -> None:
+        """A user writes to the bot"""
+        self.updates.append({"update_id": next(self.update_ids),
+                             "message": self.message(chat_id, text, bot=False)})
+        self.arrived.set()
+
+    async def reply(self, chat_id: int) -> Tuple[float, str]:
+        """:returns the next reply of the bot to the chat, waiting for it"""
+        return await self.replies.setdefault(chat_id, asyncio.Queue()).get()
+
+    async def getMe(self, request: Request):
+        self.calls["getMe"] += 1
+        return self.answer({"id": 1, "is_bot": True, "first_name": "bot",
+                            "username": "fake_bot", "can_join_groups": False,
+                            "can_read_all_group_messages": False,
+                            "supports_inline_queries": False})
+
+    async def deleteWebhook(self, request: Request):
+        self.calls["deleteWebhook"] += 1
+        return self.answer(True)
+
+    async def getUpdates(self, request: Request):
+        self.calls["getUpdates"] += 1
+        params = self.params(request)
+        offset = int(params.get("offset", 0))
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and float(params.get("timeout", 0)):
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return self.answer(self.updates[:int(params.get("limit", 100))])
+
+    async def sendMessage(self, request: Request):
+        self.calls["sendMessage"] += 1
+        params = self.params(request)
+        chat_id, text = int(params["chat_id"]), params["text"]
+        if text.startswith(NOTIFICATION):
+            self.notifications += 1
+        else:
+            self.replies.setdefault(chat_id, asyncio.Queue()).put_nowait((time.perf_counter(),
+                                                                          text))
+        return self.answer(self.message(chat_id, text, bot=True))
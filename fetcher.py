@@ -0,0 +1,213 @@
+import logging
+import re
+import threading
+from collections import defaultdict
+from itertools import zip_longest
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import gspread
+import requests
+from gspread.urls import DRIVE_FILES_API_V3_URL
+from gspread.utils import a1_to_rowcol, absolute_range_name
+
+from config import CHANGE_DETECTION
+from governor import Governor
+from handles import HandleCache, SpreadsheetHandle
+from metrics import API_CALLS, API_ERRORS, SPREADSHEET_POLL
+
+# A1 range inside a worksheet: a cell, or two cells, columns or rows with a colon between
+A1_RANGE = re.compile(r"([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?", re.IGNORECASE)
+
+
+def range_start(name: str) -> Tuple[int, int]:
+    """:returns row and column of the top left cell of the A1 range, 1 and 1 for the whole
+    worksheet or a name that is not A1"""
+    match = A1_RANGE.fullmatch(name)
+    if match is None:
+        return 1, 1
+    letters, digits = match.group(1, 2)
+    return (int(digits) if digits else 1,
+            a1_to_rowcol(f"{letters}1")[1] if letters else 1)
+
+
+def transpose(values: List[List[str]]) -> List[List[str]]:
+    """Turns rows into columns, missing cells are empty strings"""
+    return [list(column) for column in zip_longest(*values, fillvalue='')]
+
+
+class FetchPlanner:
+    """Coalesces reads of many checkers into one values request per spreadsheet"""
+    governor: Governor
+    handles: HandleCache
+    change_detection: bool
+
+    def __init__(self, governor: Governor, change_detection: bool = CHANGE_DETECTION):
+        self.governor = governor
+        self.handles = HandleCache(governor)
+        self.change_detection = change_detection
+        # Reads taken for the polls of spreadsheets that haven't started yet
+        self.admitted: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def admit(self, key: str) -> bool:
+        """Takes the reads a poll of the spreadsheet needs, opening it takes two more, if its
+        account has them free beyond the reserve for commands. Polls of spreadsheets not
+        admitted wait for a later tick instead of blocking a poll thread on the quota"""
+        reads = 1 if self.handles.fresh(key) else 3
+        if not self.governor.admit(key, reads):
+            return False
+        with self.lock:
+            self.admitted[key] = self.admitted.get(key, 0) + reads
+        return True
+
+    def release(self, key: str) -> None:
+        """Gives back the reads of an admitted spreadsheet that is not polled"""
+        self.governor.refund(key, self.take(key))
+
+    def take(self, key: str) -> int:
+        with self.lock:
+            return self.admitted.pop(key, 0)
+
+    @staticmethod
+    def group(checkers: Iterable) -> Dict[str, List]:
+        by_spreadsheet: Dict[str, List] = defaultdict(list)
+        for checker in checkers:
+            by_spreadsheet[checker.spreadsheet_id].append(checker)
+        return by_spreadsheet
+
+    def fetch(self, checkers: Iterable) -> None:
+        """Groups checkers by spreadsheet and feeds every checker its slice
+        :raise gspread.WorksheetNotFound if a checker's worksheet doesn't exist"""
+        for key, group in self.group(checkers).items():
+            missing = self.fetch_spreadsheet(key, group)
+            if missing:
+                raise gspread.WorksheetNotFound(f"index {missing[0].worksheet_index} not found")
+
+    def poll(self, checkers: Iterable) -> None:
+        """Same as fetch, but a failing spreadsheet doesn't stop the others"""
+        for key, group in self.group(checkers).items():
+            self.poll_spreadsheet(key, group)
+
+    def poll_spreadsheet(self, key: str, checkers: List) -> None:
+        """Requests of an admitted spreadsheet use its taken reads"""
+        with SPREADSHEET_POLL.time(), self.governor.prepaid(key, self.take(key)):
+            self._poll_spreadsheet(key, checkers)
+
+    def _poll_spreadsheet(self, key: str, checkers: List) -> None:
+        # A poll failing midway leaves news only of the checkers it has fed
+        for checker in checkers:
+            checker.answer = ''
+        if self.governor.breaker.allow(key):
+            try:
+                self.fetch_spreadsheet(key, checkers)
+                self.governor.breaker.success(key)
+            except (gspread.exceptions.GSpreadException, requests.RequestException):
+                logging.exception("Can't fetch spreadsheet %s", key)
+                API_ERRORS.inc(spreadsheet=key)
+                self.governor.breaker.failure(key)
+
+    def fetch_version(self, key: str) -> str:
+        """:returns Drive version of the file, it grows with every change of the spreadsheet"""
+        API_CALLS.inc(spreadsheet=key, kind="version")
+        # Drive requests don't take from the Sheets quota
+        response = self.governor.call(key, self.governor.client_for(key).http_client.request, "get",
+                                      f"{DRIVE_FILES_API_V3_URL}/{key}", quota=False,
+                                      params={"fields": "version", "supportsAllDrives": True})
+        return response.json()["version"]
+
+    def fetch_spreadsheet(self, key: str, checkers: List) -> List:
+        """Feeds the checkers whose worksheets exist
+        :returns the others, they are left as they were"""
+        version: Optional[str] = None
+        if self.change_detection:
+            version = self.fetch_version(key)
+            if all(checker.version == version for checker in checkers):
+                for checker in checkers:
+                    checker.answer = ''
+                return []
+        try:
+            missing = self.fetch_values(key, self.handle(key, version, checkers), checkers)
+        except (gspread.WorksheetNotFound, gspread.exceptions.APIError) as e:
+            # The cached worksheet titles may be out of date, so the request is repeated once
+            # with a fresh handle. Errors other than a bad range are not about the cache
+            if key not in self.handles or (isinstance(e, gspread.exceptions.APIError)
+                                           and e.response.status_code != 400):
+                raise
+            self.handles.invalidate(key)
+            missing = self.fetch_values(key, self.handle(key, version, checkers), checkers)
+        # Missing checkers get the version too, so they don't make every poll fetch values.
+        # Skipped ranges were beyond the grid of a handle of this version, so they are empty
+        for checker in checkers:
+            checker.version = version
+        return missing
+
+    def handle(self, key: str, version: Optional[str], checkers: List) -> SpreadsheetHandle:
+        """:returns the cached handle, or a fresh one when the cached one may be out of date:
+        a checker's worksheet is missing from it or a range is beyond its grid, and it was
+        opened before the spreadsheet's last change"""
+        cached = key in self.handles
+        handle = self.handles.get(key)
+        if cached and not self.current(handle, version) and any(
+                not handle.has(checker.worksheet_index)
+                or any(self.outside(handle.worksheets[checker.worksheet_index], name)
+                       for name in checker.get_ranges())
+                for checker in checkers):
+            self.handles.invalidate(key)
+            handle = self.handles.get(key)
+            cached = False
+        if not cached:
+            handle.version = version
+            handle.checked = True
+        return handle
+
+    @staticmethod
+    def current(handle: SpreadsheetHandle, version: Optional[str]) -> bool:
+        """Without change detection a handle opened by a poll is taken as current until it
+        expires"""
+        return handle.checked if version is None else handle.version == version
+
+    @staticmethod
+    def outside(worksheet: gspread.Worksheet, name: str) -> bool:
+        """Ranges starting outside the grid are empty, the API rejects them"""
+        row, col = range_start(name)
+        return row > worksheet.row_count or col > worksheet.col_count
+
+    def fetch_values(self, key: str, handle: SpreadsheetHandle, checkers: List) -> List:
+        """:returns checkers whose worksheets are missing, they are not fed"""
+        # Identical ranges are requested once and shared by all their checkers
+        positions: Dict[str, int] = {}
+        checker_ranges = []
+        missing = []
+        for checker in checkers:
+            if not handle.has(checker.worksheet_index):
+                missing.append(checker)
+                continue
+            worksheet = handle.worksheets[checker.worksheet_index]
+            names = []
+            for name in checker.get_ranges():
+                if self.outside(worksheet, name):
+                    names.append(None)
+                    continue
+                names.append(absolute_range_name(worksheet.title, name))
+                positions.setdefault(names[-1], len(positions))
+            checker_ranges.append((checker, names))
+        if missing:
+            logging.warning("Spreadsheet %s has no worksheets %s", key,
+                            sorted({checker.worksheet_index for checker in missing}))
+        # One request per spreadsheet, so columns come as columns only when nobody needs rows
+        columns = all(checker.major_dimension == "COLUMNS" for checker, _ in checker_ranges)
+        value_ranges = []
+        if positions:
+            API_CALLS.inc(spreadsheet=key, kind="values")
+            params = {"majorDimension": "COLUMNS" if columns else "ROWS",
+                      "valueRenderOption": "FORMATTED_VALUE"}
+            response = self.governor.call(key, handle.spreadsheet.values_batch_get,
+                                          list(positions), params=params)
+            value_ranges = response.get("valueRanges", [])
+        for checker, names in checker_ranges:
+            values = [value_ranges[positions[name]].get("values", []) if name else []
+                      for name in names]
+            if checker.major_dimension == "COLUMNS" and not columns:
+                values = list(map(transpose, values))
+            checker.feed(*values)
+        return missing
@@ -0,0 +1,220 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence
+
+import gspread
+import requests
+
+from clients import make_client
+from config import API_BACKOFF, API_BACKOFF_CAP, API_RETRIES, BREAKER_COOLDOWN, \
+    BREAKER_MAX_COOLDOWN, BREAKER_THRESHOLD, QUOTA_COMMAND_RESERVE, QUOTA_READS_PER_MINUTE
+from hashring import HashRing
+from metrics import API_RETRIES as API_RETRIES_TOTAL, QUOTA_WAIT
+
+RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class Quota:
+    """Token bucket of requests per minute. Threads wait in acquire until a token is free"""
+    # The account's whole quota and this process's part of it
+    limit: float
+    per_minute: float
+
+    def __init__(self, per_minute: float = QUOTA_READS_PER_MINUTE):
+        self.limit = per_minute
+        self.per_minute = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """:returns seconds spent waiting"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) * 60 / self.per_minute
+            time.sleep(delay)
+            waited += delay
+
+    def try_acquire(self, count: int = 1, keep: float = 0) -> bool:
+        """Takes count tokens without waiting if keep tokens more are free. A quota smaller
+        than that is taken whole"""
+        with self.lock:
+            self.refill()
+            if self.tokens >= min(count + keep, self.per_minute):
+                self.tokens -= count
+                return True
+            return False
+
+    def refund(self, count: int = 1) -> None:
+        """Gives back tokens that were taken but not used"""
+        with self.lock:
+            self.tokens = min(self.per_minute, self.tokens + count)
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.per_minute,
+                          self.tokens + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def share(self, shares: int) -> None:
+        """Leaves this process its part of the quota when the account is used by several"""
+        with self.lock:
+            self.per_minute = self.limit / shares
+            self.tokens = min(self.tokens, self.per_minute)
+
+
+class Account:
+    """Service account with its own read quota. Its client is made by the factory from the
+    account name on the first use"""
+    name: str
+    quota: Quota
+    factory: Callable[[str], gspread.Client]
+
+    def __init__(self, name: str, quota: Quota,
+                 factory: Callable[[str], gspread.Client] = make_client):
+        self.name = name
+        self.quota = quota
+        self.factory = factory
+        self._client = None
+        self.lock = threading.Lock()
+
+    @property
+    def client(self) -> gspread.Client:
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    self._client = self.factory(self.name)
+        return self._client
+
+
+class AccountPool:
+    """Spreads spreadsheets over accounts by consistent hashing, so adding an account moves
+    only a share of spreadsheets to it"""
+    accounts: List[Account]
+
+    def __init__(self, accounts: Sequence[Account]):
+        self.accounts = list(accounts)
+        self.ring = HashRing(self.accounts, name=lambda account: account.name)
+
+    @classmethod
+    def from_files(cls, filenames: Sequence[str]) -> "AccountPool":
+        return cls([Account(filename, Quota()) for filename in filenames])
+
+    def account_for(self, key: str) -> Account:
+        return self.ring.node_for(key)
+
+
+class CircuitBreaker:
+    """Stops polling of spreadsheets that keep failing"""
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN,
+                 max_cooldown: float = BREAKER_MAX_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures: Dict[str, int] = {}
+        self.open_until: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        with self.lock:
+            return self.open_until.get(key, 0) <= time.monotonic()
+
+    def success(self, key: str) -> None:
+        with self.lock:
+            self.failures.pop(key, None)
+            self.open_until.pop(key, None)
+
+    def failure(self, key: str) -> None:
+        with self.lock:
+            failures = self.failures[key] = self.failures.get(key, 0) + 1
+            if failures >= self.threshold:
+                cooldown = min(self.max_cooldown,
+                               self.cooldown * 2 ** (failures - self.threshold))
+                self.open_until[key] = time.monotonic() + cooldown
+                logging.warning("Spreadsheet %s failed %d times, resting for %d seconds",
+                                key, failures, cooldown)
+
+    @property
+    def open(self) -> int:
+        now = time.monotonic()
+        with self.lock:
+            return sum(1 for until in self.open_until.values() if until > now)
+
+
+class Governor:
+    """Every Google request goes through here: it takes the account of the spreadsheet, waits
+    for its quota and repeats throttled and failed requests with jittered exponential backoff.
+    Polls don't wait: a poll is admitted with its reads taken in advance, and only while the
+    account has reads free beyond the reserve for commands
+    """
+    pool: AccountPool
+    breaker: CircuitBreaker
+    reserve: float
+
+    def __init__(self, pool: AccountPool, retries: int = API_RETRIES,
+                 backoff: float = API_BACKOFF, backoff_cap: float = API_BACKOFF_CAP,
+                 reserve: float = QUOTA_COMMAND_RESERVE):
+        self.pool = pool
+        self.breaker = CircuitBreaker()
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.reserve = reserve
+        # Reads taken in advance by the poll running in the thread
+        self.local = threading.local()
+
+    def client_for(self, key: str) -> gspread.Client:
+        return self.pool.account_for(key).client
+
+    def share(self, shares: int) -> None:
+        """Every process using the accounts takes an equal part of their quotas"""
+        for account in self.pool.accounts:
+            account.quota.share(shares)
+
+    def admit(self, key: str, reads: int = 1) -> bool:
+        """Takes reads for a poll of the spreadsheet if its account has them free beyond the
+        reserve. The poll runs in prepaid"""
+        return self.pool.account_for(key).quota.try_acquire(reads, self.reserve)
+
+    def refund(self, key: str, reads: int = 1) -> None:
+        if reads:
+            self.pool.account_for(key).quota.refund(reads)
+
+    @contextmanager
+    def prepaid(self, key: str, reads: int):
+        """Requests of the spreadsheet inside use the reads taken by admit first, the reads
+        no request needs go back to the quota"""
+        self.local.prepaid = reads
+        try:
+            yield
+        finally:
+            self.refund(key, self.local.prepaid)
+            self.local.prepaid = 0
+
+    def call(self, key: str, func: Callable, *args, quota: bool = True, **kwargs):
+        """Calls func for the spreadsheet key, quota=False for requests outside Sheets quota"""
+        account = self.pool.account_for(key)
+        for attempt in range(self.retries + 1):
+            if quota and getattr(self.local, "prepaid", 0):
+                self.local.prepaid -= 1
+            elif quota:
+                QUOTA_WAIT.observe(account.quota.acquire(), account=account.name)
+            try:
+                return func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                if e.response.status_code not in RETRIABLE_STATUSES or attempt == self.retries:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            API_RETRIES_TOTAL.inc(spreadsheet=key)
+            time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff * 2 ** attempt)))
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import gspread
+
+from config import HANDLE_CACHE_SIZE, HANDLE_TTL
+from governor import Governor
+from metrics import API_CALLS
+
+
+class SpreadsheetHandle:
+    """Opened spreadsheet with its worksheets in their current order"""
+    spreadsheet: gspread.Spreadsheet
+    worksheets: List[gspread.Worksheet]
+    expires: float
+    # Drive version read before a poll opened the handle, its worksheets and grid sizes are at
+    # least that new
+    version: Optional[str]
+    # Opened by a poll rather than by a command
+    checked: bool
+
+    def __init__(self, spreadsheet: gspread.Spreadsheet, worksheets: List[gspread.Worksheet],
+                 expires: float):
+        self.spreadsheet = spreadsheet
+        self.worksheets = worksheets
+        self.expires = expires
+        self.version = None
+        self.checked = False
+
+    def has(self, index: int) -> bool:
+        return 0 <= index < len(self.worksheets)
+
+    def worksheet(self, index: int) -> gspread.Worksheet:
+        try:
+            return self.worksheets[index]
+        except IndexError:
+            raise gspread.WorksheetNotFound(f"index {index} not found")
+
+
+class HandleCache:
+    """Spreadsheet handles by spreadsheet ID with TTL expiry and LRU eviction.
+    Safe to use from the polling threads
+    """
+    governor: Governor
+    ttl: float
+    size: int
+
+    def __init__(self, governor: Governor, ttl: float = HANDLE_TTL,
+                 size: int = HANDLE_CACHE_SIZE):
+        self.governor = governor
+        self.ttl = ttl
+        self.size = size
+        self.handles: OrderedDict[str, SpreadsheetHandle] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key: str):
+        with self.lock:
+            return key in self.handles
+
+    def fresh(self, key: str) -> bool:
+        """:returns whether get would return the cached handle"""
+        with self.lock:
+            handle = self.handles.get(key)
+            return handle is not None and handle.expires > time.monotonic()
+
+    def get(self, key: str) -> SpreadsheetHandle:
+        now = time.monotonic()
+        with self.lock:
+            handle = self.handles.get(key)
+            if handle is not None and handle.expires > now:
+                self.handles.move_to_end(key)
+                return handle
+        sh = self.governor.call(key, self.governor.client_for(key).open_by_key, key)
+        handle = SpreadsheetHandle(sh, self.governor.call(key, sh.worksheets), now + self.ttl)
+        API_CALLS.inc(2, spreadsheet=key, kind="metadata")
+        with self.lock:
+            self.handles[key] = handle
+            self.handles.move_to_end(key)
+            while len(self.handles) > self.size:
+                self.handles.popitem(last=False)
+        return handle
+
+    def invalidate(self, key: str) -> None:
+        """Forgets the handle, e.g. after its worksheets were deleted, renamed or reordered"""
+        with self.lock:
+            self.handles.pop(key, None)
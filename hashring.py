@@ -0,0 +1,28 @@
+import bisect
+import hashlib
+from typing import Callable, Generic, List, Sequence, Tuple, TypeVar
+
+Node = TypeVar("Node")
+
+
+def stable_hash(value: str) -> int:
+    """Same in every process, unlike hash() of a string"""
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing(Generic[Node]):
+    """Consistent hashing with virtual nodes: adding or removing a node moves only the keys
+    of its share of the ring"""
+    nodes: List[Node]
+
+    def __init__(self, nodes: Sequence[Node], name: Callable[[Node], str] = str,
+                 replicas: int = 100):
+        self.nodes = list(nodes)
+        self.ring: List[Tuple[int, Node]] = sorted(
+            ((stable_hash(f"{name(node)}#{replica}"), node)
+             for node in self.nodes for replica in range(replicas)), key=lambda item: item[0])
+        self.points = [point for point, _ in self.ring]
+
+    def node_for(self, key: str) -> Node:
+        index = bisect.bisect(self.points, stable_hash(key)) % len(self.ring)
+        return self.ring[index][1]
@@ -0,0 +1,110 @@
+import asyncio
+import itertools
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+class Request:
+    method: str
+    path: str
+    query: Dict[str, list]
+    headers: Dict[str, str]
+    body: bytes
+
+    def __init__(self, method: str, target: str, headers: Dict[str, str], body: bytes):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = parse_qs(url.query)
+        self.headers = headers
+        self.body = body
+
+
+# Handler returns status, content type and body
+Handler = Callable[[Request], Awaitable[Tuple[int, str, bytes]]]
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Content Too Large",
+           431: "Request Header Fields Too Large", 500: "Internal Server Error"}
+# Header lines of one request
+MAX_HEADERS = 100
+# Largest request body read, bytes. Larger requests get 413 unread
+MAX_BODY = 1 << 20
+# Seconds to wait for a request's head or body, and for the next request on a kept-alive
+# connection, before closing the connection
+READ_TIMEOUT = 30.0
+
+
+async def read_head(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str]]]:
+    """:returns method, target and headers, None when the connection is closed
+    :raise ValueError if the head is malformed, OverflowError if it has too many headers"""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    for count in itertools.count():
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if count == MAX_HEADERS:
+            raise OverflowError("too many headers")
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return method, target, headers
+
+
+async def serve(routes: Dict[str, Handler], host: str, port: int, max_body: int = MAX_BODY,
+                timeout: float = READ_TIMEOUT) -> asyncio.AbstractServer:
+    """Minimal HTTP/1.1 server on the running loop, a handler is chosen by the exact path.
+    The body's size is checked before it is read, and a client that is slow to send a request
+    or keeps a connection idle for longer than the timeout is disconnected"""
+
+    def respond(writer: asyncio.StreamWriter, status: int, content_type: str,
+                answer: bytes) -> None:
+        writer.write(f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}\r\n"
+                     f"Content-Type: {content_type}\r\n"
+                     f"Content-Length: {len(answer)}\r\n\r\n".encode("latin-1") + answer)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(read_head(reader), timeout)
+                except OverflowError:
+                    respond(writer, 431, "text/plain", b"too many headers")
+                    break
+                if head is None:
+                    break
+                method, target, headers = head
+                length = headers.get("content-length", "0")
+                if not length.isdigit():
+                    respond(writer, 400, "text/plain", b"bad content length")
+                    break
+                # The rest of a rejected request is never read, so the connection is closed
+                if int(length) > max_body:
+                    respond(writer, 413, "text/plain", b"body too large")
+                    break
+                body = await asyncio.wait_for(reader.readexactly(int(length)), timeout)
+                request = Request(method, target, headers, body)
+                handler = routes.get(request.path)
+                if handler is None:
+                    status, content_type, answer = 404, "text/plain", b"not found"
+                else:
+                    try:
+                        status, content_type, answer = await handler(request)
+                    except Exception:
+                        logging.exception("Error in HTTP handler of %s", request.path)
+                        status, content_type, answer = 500, "text/plain", b"error"
+                respond(writer, status, content_type, answer)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,264 @@
+"""End-to-end load test of the conversations. Simulated chats go through /add_table,
+/add_checker and /delete_checker with a local fake Bot API, while the bot polls fake
+spreadsheets in the background. The same load is run once more without polling, and the test
+exits with 1 when the command p99 is over the budget or polling adds more than the delta
+budget to it:
+
+    python loadtest.py --chats 100 --tables 1000 --accounts 20 --budget 1000
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from bench import percentile
+from fake_sheets import FakeClient
+from fake_telegram import FakeBotApi
+
+TOKEN = "123456:load-test"
+# Preloaded tables belong to chats from here on, simulated chats are below
+PRELOADED_CHATS = 10 ** 9
+
+
+def script(chat: int, ref: str) -> List[Tuple[str, str, int]]:
+    """:returns (conversation, message, number of replies to it) of one simulated chat"""
+    name = f"table{chat}"
+    checker = [("Одна ячейка", 1), ("B2", 1)]
+    steps = [("add_table", "/add_table", 2), ("add_table", name, 1), ("add_table", ref, 1)]
+    for conversation in ("add_checker", "delete_checker"):
+        steps += [(conversation, f"/{conversation}", 2), (conversation, name, 1),
+                  (conversation, "0", 1)]
+        steps += [(conversation, text, replies) for text, replies in checker]
+    return steps
+
+
+async def user(api: FakeBotApi, chat: int, ref: str, args, latencies: Dict[str, list],
+               failures: Dict[str, int]) -> None:
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    for conversation, text, replies in script(chat, ref):
+        await asyncio.sleep(random.uniform(0, args.think))
+        sent = time.perf_counter()
+        api.send_text(chat, text)
+        try:
+            for _ in range(replies):
+                received, _ = await asyncio.wait_for(api.reply(chat), args.timeout)
+        except asyncio.TimeoutError:
+            failures[conversation] += 1
+            return
+        latencies[conversation].append(received - sent)
+
+
+class UserThread(threading.Thread):
+    """Fake Bot API and the simulated chats, on their own loop so they don't stall the bot's"""
+
+    def __init__(self, api: FakeBotApi, refs: List[str], args):
+        super().__init__(daemon=True)
+        self.api = api
+        self.refs = refs
+        self.args = args
+        self.port = concurrent.futures.Future()
+        self.go = concurrent.futures.Future()
+        self.done = concurrent.futures.Future()
+        self.latencies: Dict[str, list] = defaultdict(list)
+        self.failures: Dict[str, int] = defaultdict(int)
+
+    def run(self):
+        asyncio.run(self.simulate())
+
+    async def simulate(self):
+        server = await self.api.start()
+        self.port.set_result(server.sockets[0].getsockname()[1])
+        await asyncio.wrap_future(self.go)
+        await asyncio.gather(*(user(self.api, chat, random.choice(self.refs), self.args,
+                                    self.latencies, self.failures)
+                               for chat in range(1, self.args.chats + 1)))
+        self.done.set_result(None)
+        # The bot still long-polls until it stops
+        await asyncio.sleep(self.args.timeout)
+
+
+async def watch_loop(stalls: List[float], period: float = 0.01) -> None:
+    """Records how much later than asked the loop wakes up"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(period)
+        stalls.append(loop.time() - start - period)
+
+
+async def run_bot(app, allowed_updates: List[str], users: UserThread,
+                  stalls: List[float]) -> None:
+    async with app:
+        await app.start()
+        await app.updater.start_polling(poll_interval=0, timeout=1,
+                                        allowed_updates=allowed_updates)
+        monitor = asyncio.create_task(watch_loop(stalls))
+        users.go.set_result(None)
+        await asyncio.wrap_future(users.done)
+        monitor.cancel()
+        await app.updater.stop()
+        await app.stop()
+
+
+def mutate(client: FakeClient, args, stop: threading.Event) -> None:
+    while not stop.wait(1):
+        for key in list(client.spreadsheets):
+            if client.random.random() < args.mutation_rate:
+                client.mutate(key, args.mutated_cells)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=50, help="simulated chats")
+    parser.add_argument("--tables", type=int, default=500,
+                        help="tables watched from the start, polled in the background")
+    parser.add_argument("--spreadsheets", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--cols", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per API call")
+    parser.add_argument("--accounts", type=int, default=10,
+                        help="service accounts the spreadsheets are spread over")
+    parser.add_argument("--quota", type=float,
+                        help="reads per minute of every account, QUOTA_READS_PER_MINUTE if not "
+                             "given")
+    parser.add_argument("--mutation-rate", type=float, default=0.1,
+                        help="share of spreadsheets changed every second")
+    parser.add_argument("--mutated-cells", type=int, default=5)
+    parser.add_argument("--poll-interval", type=float, default=5,
+                        help="shortest poll interval of a table, seconds")
+    parser.add_argument("--ramp", type=float, default=10,
+                        help="chats start during this many seconds")
+    parser.add_argument("--think", type=float, default=0.5,
+                        help="longest pause of a user before a message, seconds")
+    parser.add_argument("--timeout", type=float, default=30, help="longest wait for a reply")
+    parser.add_argument("--budget", type=float, default=1000, help="command p99 budget, ms")
+    parser.add_argument("--delta-budget", type=float, default=500,
+                        help="command p99 that polling may add to the one without polling, ms")
+    parser.add_argument("--push", action="store_true",
+                        help="spreadsheets are watched by Drive channels of the fake")
+    parser.add_argument("--channel-ttl", type=float,
+                        help="lifetime of the fake's channels, seconds, to make them lapse")
+    parser.add_argument("--seed", type=int, default=0)
+    # The run without polling, started by the test itself
+    parser.add_argument("--baseline", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    directory = tempfile.mkdtemp(prefix="loadtest")
+    accounts = ','.join(f"loadtest{index}.json" for index in range(args.accounts))
+    # Preloaded tables are never due when polling is off
+    os.environ.update(DATABASE=os.path.join(directory, "base.sqlite3"),
+                      BASE_JSON=os.path.join(directory, "base.json"),
+                      POLL_INTERVAL=str(10 ** 9 if args.baseline else args.poll_interval),
+                      SERVICE_ACCOUNT_FILES=accounts, METRICS_PORT="0",
+                      POLLER_SHARDS="0", WEBHOOK_URL="")
+    if args.quota is not None:
+        os.environ["QUOTA_READS_PER_MINUTE"] = str(args.quota)
+    if args.push and not args.baseline:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        os.environ.update(PUSH_URL=f"http://127.0.0.1:{port}/drive", PUSH_HOST="127.0.0.1",
+                          PUSH_PORT=str(port), PUSH_TICK="1", PUSH_BATCH=str(args.spreadsheets),
+                          PUSH_RENEW_MARGIN=str(min(600, (args.channel_ttl or 3600) / 2)))
+    import bot
+    from checkers import CellChecker, SheetChecker, governor
+    from config import CONCURRENT_UPDATES
+    from telegram.ext import Application
+    from webhook import ChatUpdateProcessor
+    # A log line per request and job would be most of the work
+    for name in ("httpx", "apscheduler"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    client = FakeClient(args.latency, args.seed)
+    client.channel_ttl = args.channel_ttl
+    for account in governor.pool.accounts:
+        account.factory = lambda _: client
+    refs = []
+    for index in range(args.spreadsheets):
+        key = f"load{index:06d}"
+        client.add_spreadsheet(key, 1, args.rows, args.cols)
+        refs.append(f"https://docs.google.com/spreadsheets/d/{key}/edit")
+    # The preloaded tables go through the usual import of the JSON base
+    base = defaultdict(dict)
+    for index in range(args.tables):
+        ref = random.choice(refs)
+        table = bot.Table(ref, f"table{index}")
+        table.add_checker(SheetChecker(ref, 0) if index % 10 == 0 else CellChecker(ref, 0, "C3"))
+        base[str(PRELOADED_CHATS + index)][table.name] = table
+    with open(os.environ["BASE_JSON"], "w") as f:
+        json.dump(base, f, default=bot.BaseHelper.encode)
+
+    api = FakeBotApi(TOKEN)
+    users = UserThread(api, refs, args)
+    users.start()
+    app = Application.builder().token(TOKEN) \
+        .base_url(f"http://127.0.0.1:{users.port.result()}/bot") \
+        .concurrent_updates(ChatUpdateProcessor(CONCURRENT_UPDATES)).build()
+    allowed_updates = bot.add_handlers(app)
+    stop = threading.Event()
+    threading.Thread(target=mutate, args=(client, args, stop), daemon=True).start()
+    stalls: List[float] = []
+    start = time.perf_counter()
+    with bot.BaseHelper(app):
+        asyncio.run(run_bot(app, allowed_updates, users, stalls))
+    stop.set()
+    total = time.perf_counter() - start
+
+    everything = [latency for latencies in users.latencies.values() for latency in latencies]
+    print(f"chats {args.chats}, preloaded tables {args.tables}, "
+          f"spreadsheets {args.spreadsheets}, {total:.1f} s")
+    print(f"{'conversation':16} {'steps':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"
+          f" {'failed':>7}")
+    for conversation, latencies in sorted(users.latencies.items()) + [("all", everything)]:
+        failed = (sum(users.failures.values()) if conversation == "all"
+                  else users.failures[conversation])
+        print(f"{conversation:16} {len(latencies):6}" +
+              ''.join(f" {percentile(latencies, share) * 1000:6.0f}ms"
+                      for share in (0.5, 0.95, 0.99)) +
+              f" {max(latencies, default=0) * 1000:6.0f}ms {failed:7}")
+    print(f"loop stalls      p50 {percentile(stalls, 0.5) * 1000:.1f} ms, "
+          f"p99 {percentile(stalls, 0.99) * 1000:.1f} ms, "
+          f"max {max(stalls, default=0) * 1000:.1f} ms")
+    print(f"google calls     {dict(client.calls)}")
+    print(f"notifications    {api.notifications}")
+    p99 = percentile(everything, 0.99) * 1000 if everything else float("inf")
+    failed = sum(users.failures.values())
+    if args.baseline:
+        print(json.dumps({"p99": p99, "failed": failed}))
+        return
+    baseline = measure_baseline()
+    delta = p99 - baseline["p99"]
+    print(f"without polling  p99 {baseline['p99']:.0f} ms, polling adds {delta:.0f} ms, "
+          f"{baseline['failed']} conversations failed")
+    if p99 > args.budget or delta > args.delta_budget or failed or baseline["failed"]:
+        print(f"FAIL: command p99 {p99:.0f} ms, budget {args.budget:.0f} ms, polling adds "
+              f"{delta:.0f} ms, budget {args.delta_budget:.0f} ms, "
+              f"{failed + baseline['failed']} conversations failed")
+        sys.exit(1)
+    print(f"OK: command p99 {p99:.0f} ms, budget {args.budget:.0f} ms, polling adds "
+          f"{delta:.0f} ms, budget {args.delta_budget:.0f} ms")
+
+
+def measure_baseline() -> dict:
+    """Runs the same load without polling in a fresh process
+    :returns its command p99, ms, and number of failed conversations"""
+    logging.info("Running the load without polling")
+    run = subprocess.run([sys.executable, __file__, *sys.argv[1:], "--baseline"],
+                         stdout=subprocess.PIPE, text=True, check=True)
+    return json.loads(run.stdout.splitlines()[-1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from httpd import Request
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 100000)
+
+# Called as tracer(name, seconds, labels) after every timed span, e.g. to trace one poll
+tracer: Optional[Callable[[str, float, Dict[str, str]], None]] = None
+
+
+def set_tracer(callback: Optional[Callable[[str, float, Dict[str, str]], None]]) -> None:
+    global tracer
+    tracer = callback
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Base of metrics in the Prometheus text format. Values are kept by label values"""
+    kind = "untyped"
+    name: str
+    help: str
+    labelnames: Tuple[str, ...]
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 registry: Optional["Registry"] = None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        return (f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+                + "".join(line + "\n" for line in self.samples()))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_labels(self.labelnames, key)} {value}"
+                    for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """Either set directly or read from a function at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, *args, function: Optional[Callable[[], float]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self) -> List[str]:
+        if self.function is not None:
+            return [f"{self.name} {self.function()}"]
+        with self.lock:
+            return [f"{self.name}{_labels(self.labelnames, key)} {value}"
+                    for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    buckets: Tuple[float, ...]
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # Per label values: counts by bucket (the last one is +Inf), sum
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = [counts, total + value]
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(seconds, **labels)
+            if tracer is not None:
+                tracer(self.name, seconds, labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    labels = _labels(self.labelnames, key, f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> None:
+        self.metrics.append(metric)
+
+    def expose(self) -> str:
+        return "".join(metric.expose() for metric in self.metrics)
+
+
+REGISTRY = Registry()
+
+
+async def handle_metrics(request: Request):
+    return 200, "text/plain; version=0.0.4; charset=utf-8", REGISTRY.expose().encode()
+
+
+# Metrics of the polling pipeline
+POLL_CYCLE = Histogram("poll_cycle_seconds", "Poll of the tables due at one scheduler tick")
+SPREADSHEET_POLL = Histogram("spreadsheet_poll_seconds",
+                             "Poll of one spreadsheet for all its due checkers")
+FAN_OUT = Histogram("fan_out_seconds", "Handing polled checkers' news to their tables")
+CHECKER_UPDATE = Histogram("checker_update_seconds", "Fetches of newly added checkers",
+                           ["checker"])
+CHECKER_GET_DATA = Histogram("checker_get_data_seconds", "Parsing of fetched values", ["checker"])
+CHECKER_GET_NEWS = Histogram("checker_get_news_seconds", "Diffing of checker data", ["checker"])
+DIFF_SIZE = Histogram("diff_changed_cells", "Changed cells found by one diff", ["checker"],
+                      buckets=SIZE_BUCKETS)
+API_CALLS = Counter("google_api_calls_total", "Google API requests", ["spreadsheet", "kind"])
+API_ERRORS = Counter("google_api_errors_total", "Failed polls of a spreadsheet", ["spreadsheet"])
+DUMP = Histogram("dump_seconds", "Writes of changed tables to the storage")
+SEND = Histogram("telegram_send_seconds", "Telegram send_message calls")
+SEND_ERRORS = Counter("telegram_send_errors_total", "Failed send_message calls", ["reason"])
+SCHEDULER_LAG = Gauge("scheduler_lag_seconds", "How late the most overdue poll is")
+WATCHED_TABLES = Gauge("watched_tables", "Tables in the poll scheduler")
+SEND_BACKLOG = Gauge("telegram_send_backlog", "Notifications waiting to be sent")
+SNAPSHOT_BYTES = Gauge("snapshot_resident_bytes", "Memory taken by sheet snapshots")
+API_RETRIES = Counter("google_api_retries_total", "Repeated Google API requests", ["spreadsheet"])
+QUOTA_WAIT = Histogram("google_quota_wait_seconds", "Waiting for a free request in the quota",
+                       ["account"])
+OPEN_BREAKERS = Gauge("open_circuit_breakers", "Spreadsheets resting after failures")
+PUSH_NOTIFICATIONS = Counter("drive_push_notifications_total", "Notifications of Drive channels",
+                             ["state"])
+PUSH_CHANNELS = Gauge("drive_push_channels", "Spreadsheets with a Drive channel")
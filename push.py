@@ -0,0 +1,153 @@
+"""Push mode: Drive posts a notification when a watched spreadsheet changes, and only that
+spreadsheet is polled at once. Every watched spreadsheet gets a files.watch channel that is
+renewed before it expires. A spreadsheet without a live channel is polled on schedule
+"""
+import hmac
+import logging
+import secrets
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterable, List, Optional
+
+from gspread.urls import DRIVE_FILES_API_V3_URL
+
+from config import PUSH_RENEW_MARGIN, PUSH_SECRET, PUSH_TTL
+from governor import Governor
+from httpd import Handler, Request
+from metrics import API_CALLS, PUSH_NOTIFICATIONS
+
+DRIVE_CHANNELS_STOP_URL = "https://www.googleapis.com/drive/v3/channels/stop"
+
+
+class Channel:
+    id: str
+    key: str
+    resource_id: str
+    # Unix time, seconds
+    expiration: float
+
+    def __init__(self, id: str, key: str, resource_id: str, expiration: float):
+        self.id = id
+        self.key = key
+        self.resource_id = resource_id
+        self.expiration = expiration
+
+
+class PushChannels:
+    """Drive channels by spreadsheet. Channels are opened and closed in the poll threads and
+    looked up on the loop, so the dictionaries are guarded by a lock
+    """
+    governor: Governor
+    address: str
+    token: str
+    ttl: float
+    margin: float
+
+    def __init__(self, governor: Governor, address: str, token: str = PUSH_SECRET,
+                 ttl: float = PUSH_TTL, margin: float = PUSH_RENEW_MARGIN):
+        self.governor = governor
+        self.address = address
+        self.token = token or secrets.token_urlsafe(32)
+        self.ttl = ttl
+        self.margin = margin
+        self.channels: Dict[str, Channel] = {}
+        self.by_id: Dict[str, Channel] = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.channels)
+
+    def live(self, key: str, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        channel = self.channels.get(key)
+        return channel is not None and channel.expiration > now
+
+    def due(self, keys: Iterable[str], now: Optional[float] = None) -> List[str]:
+        """:returns the keys without a channel or with one expiring within the margin"""
+        now = time.time() if now is None else now
+        return [key for key in keys if not self.live(key, now + self.margin)]
+
+    def lapsed(self, now: Optional[float] = None) -> List[str]:
+        """Forgets the expired channels
+        :returns their keys"""
+        now = time.time() if now is None else now
+        with self.lock:
+            keys = [key for key, channel in self.channels.items() if channel.expiration <= now]
+            for key in keys:
+                del self.by_id[self.channels.pop(key).id]
+        return keys
+
+    def open(self, key: str) -> Channel:
+        """Opens a channel of the spreadsheet, the channel it replaces is stopped"""
+        API_CALLS.inc(spreadsheet=key, kind="watch")
+        body = {"id": str(uuid.uuid4()), "type": "web_hook", "address": self.address,
+                "token": self.token, "expiration": int((time.time() + self.ttl) * 1000)}
+        client = self.governor.client_for(key)
+        response = self.governor.call(key, client.http_client.request, "post",
+                                      f"{DRIVE_FILES_API_V3_URL}/{key}/watch", quota=False,
+                                      params={"supportsAllDrives": True}, json=body).json()
+        # Drive may shorten the asked lifetime
+        channel = Channel(response["id"], key, response["resourceId"],
+                          int(response["expiration"]) / 1000)
+        with self.lock:
+            old = self.channels.get(key)
+            self.channels[key] = channel
+            self.by_id[channel.id] = channel
+        if old is not None:
+            self.stop(old)
+        return channel
+
+    def close(self, key: str) -> None:
+        with self.lock:
+            channel = self.channels.get(key)
+        if channel is not None:
+            self.stop(channel)
+
+    def stop(self, channel: Channel) -> None:
+        """Drive keeps notifying a channel until it is stopped, so it is forgotten only after"""
+        API_CALLS.inc(spreadsheet=channel.key, kind="stop")
+        client = self.governor.client_for(channel.key)
+        self.governor.call(channel.key, client.http_client.request, "post",
+                           DRIVE_CHANNELS_STOP_URL, quota=False,
+                           json={"id": channel.id, "resourceId": channel.resource_id})
+        with self.lock:
+            self.by_id.pop(channel.id, None)
+            if self.channels.get(channel.key) is channel:
+                del self.channels[channel.key]
+
+    def receive(self, headers: Dict[str, str]) -> Optional[str]:
+        """:returns the key of the changed spreadsheet, None for notifications without changes
+        and for channels that are not ours anymore
+        :raise PermissionError if the channel token is wrong"""
+        token = headers.get("x-goog-channel-token", "")
+        if not hmac.compare_digest(token.encode(), self.token.encode()):
+            raise PermissionError("wrong channel token")
+        state = headers.get("x-goog-resource-state", "")
+        PUSH_NOTIFICATIONS.inc(state=state)
+        with self.lock:
+            channel = self.by_id.get(headers.get("x-goog-channel-id", ""))
+        # The first notification of a channel is "sync", it only confirms the channel
+        if (channel is None or channel.resource_id != headers.get("x-goog-resource-id")
+                or state in ("sync", "")):
+            return None
+        return channel.key
+
+
+def receiver(channels: PushChannels, changed: Callable[[str], None]) -> Handler:
+    """:returns the HTTP handler of the notifications, it calls changed with the key of every
+    changed spreadsheet"""
+
+    async def receive(request: Request):
+        if request.method != "POST":
+            return 405, "text/plain", b"POST only"
+        try:
+            key = channels.receive(request.headers)
+        except PermissionError:
+            return 403, "text/plain", b"wrong channel token"
+        if key is not None:
+            logging.debug("Spreadsheet %s has changed", key)
+            changed(key)
+        return 200, "text/plain", b"ok"
+
+    return receive
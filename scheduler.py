@@ -0,0 +1,116 @@
+import heapq
+import itertools
+import random
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from config import POLL_BACKOFF, POLL_INTERVAL, POLL_JITTER, POLL_MAX_INTERVAL, POLL_MIN_INTERVAL
+
+_REMOVED = object()
+
+
+class AdaptivePolicy:
+    """Interval of a table grows backoff times after every poll without changes up to the
+    ceiling and drops to the floor after a change or when the owner works with the table.
+    Owners may pin their own floor and ceiling, but not a floor below the minimum
+    """
+    floor: float
+    ceiling: float
+    backoff: float
+    minimum: float
+
+    def __init__(self, floor: float = POLL_INTERVAL, ceiling: float = POLL_MAX_INTERVAL,
+                 backoff: float = POLL_BACKOFF, minimum: float = POLL_MIN_INTERVAL):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.backoff = backoff
+        self.minimum = minimum
+
+    def bounds(self, min_interval: Optional[float] = None,
+               max_interval: Optional[float] = None) -> Tuple[float, float]:
+        low = self.floor if min_interval is None else max(self.minimum, min_interval)
+        high = max(low, self.ceiling if max_interval is None else max_interval)
+        return low, high
+
+    def after_poll(self, interval: float, changed: bool, min_interval: Optional[float] = None,
+                   max_interval: Optional[float] = None) -> float:
+        low, high = self.bounds(min_interval, max_interval)
+        if changed:
+            return low
+        return min(high, max(low, interval * self.backoff))
+
+
+class PollScheduler:
+    """Keeps the next poll time of every watched item in a heap.
+    Removed entries are only marked and skipped later, so add, remove and reschedule are O(log n)
+    """
+    jitter: float
+
+    def __init__(self, jitter: float = POLL_JITTER):
+        self.jitter = jitter
+        self.heap: List[list] = []
+        self.entries: Dict[Hashable, list] = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    def add(self, item: Hashable, interval: float, now: Optional[float] = None) -> None:
+        """The first poll happens at a random moment of the interval, so items added together
+        are spread over it instead of firing at once"""
+        now = time.monotonic() if now is None else now
+        self.push(item, interval, now + random.uniform(0, interval))
+
+    def remove(self, item: Hashable) -> None:
+        entry = self.entries.pop(item, None)
+        if entry is None:
+            return
+        entry[-1] = _REMOVED
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [entry for entry in self.heap if entry[-1] is not _REMOVED]
+            heapq.heapify(self.heap)
+
+    def reschedule(self, item: Hashable, interval: float, now: Optional[float] = None) -> None:
+        """Sets a new interval, the next poll happens one interval from now"""
+        now = time.monotonic() if now is None else now
+        self.push(item, interval, now + self.step(interval))
+
+    def postpone(self, item: Hashable, delay: float, now: Optional[float] = None) -> None:
+        """Polls the item after the delay keeping its interval, for polls that couldn't start"""
+        entry = self.entries.get(item)
+        if entry is not None:
+            now = time.monotonic() if now is None else now
+            self.push(item, entry[2], now + delay)
+
+    def pop_due(self, now: Optional[float] = None) -> List[Hashable]:
+        """:returns items whose time has come and schedules their next polls"""
+        now = time.monotonic() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, _, interval, item = heapq.heappop(self.heap)
+            if item is _REMOVED:
+                continue
+            due.append(item)
+            entry = [max(when + self.step(interval), now), next(self.counter), interval, item]
+            self.entries[item] = entry
+            heapq.heappush(self.heap, entry)
+        return due
+
+    def lag(self, now: Optional[float] = None) -> float:
+        """:returns how late the most overdue poll is, seconds"""
+        now = time.monotonic() if now is None else now
+        while self.heap and self.heap[0][-1] is _REMOVED:
+            heapq.heappop(self.heap)
+        return max(0.0, now - self.heap[0][0]) if self.heap else 0.0
+
+    def push(self, item: Hashable, interval: float, when: float) -> None:
+        self.remove(item)
+        entry = [when, next(self.counter), interval, item]
+        self.entries[item] = entry
+        heapq.heappush(self.heap, entry)
+
+    def step(self, interval: float) -> float:
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
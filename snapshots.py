@@ -0,0 +1,213 @@
+import itertools
+import json
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import weakref
+from array import array
+from collections import OrderedDict
+from typing import Hashable, Iterator, List, Optional, Sequence
+
+from config import SNAPSHOT_MEMORY, SNAPSHOT_SPILL_DIR
+
+_table_ids = itertools.count()
+
+
+class StringTable:
+    """Append-only interning table. A string keeps its code for the table's whole life, so
+    snapshots encoded with one table compare their rows by codes"""
+    id: int
+    strings: List[str]
+    nbytes: int
+
+    def __init__(self, strings: Optional[List[str]] = None, table_id: Optional[int] = None):
+        self.id = next(_table_ids) if table_id is None else table_id
+        self.strings = strings or []
+        self.nbytes = sum(map(sys.getsizeof, self.strings))
+        self._codes = None
+
+    @property
+    def codes(self) -> dict:
+        if self._codes is None:
+            self._codes = _Codes(self)
+        return self._codes
+
+
+class _Codes(dict):
+    def __init__(self, table: StringTable):
+        super().__init__((string, code) for code, string in enumerate(table.strings))
+        self.table = table
+
+    def __missing__(self, string: str) -> int:
+        code = self[string] = len(self.table.strings)
+        self.table.strings.append(string)
+        self.table.nbytes += sys.getsizeof(string)
+        return code
+
+
+class Snapshot:
+    """Rectangular grid of strings kept as an array of codes into a string table.
+    A spilled snapshot keeps only a path and maps the file back on first access
+    """
+    height: int
+    width: int
+    table_id: int
+    # Resident size when loaded, bytes
+    nbytes: int
+    path: Optional[str]
+    # Set while the snapshot is the latest one of its worksheet in the store
+    key: Optional[Hashable]
+
+    def __init__(self, codes: Sequence[int], table: StringTable, height: int, width: int,
+                 store: Optional["SnapshotStore"] = None):
+        self._codes = codes
+        self._table = table
+        self.size = len(table.strings)
+        self.height = height
+        self.width = width
+        self.table_id = table.id
+        self.nbytes = 4 * len(codes) + table.nbytes
+        self.store = store
+        self.path = None
+        self.key = None
+
+    @classmethod
+    def empty(cls) -> "Snapshot":
+        return cls(array('I'), StringTable(), 0, 0)
+
+    @property
+    def resident(self) -> bool:
+        return self._table is not None
+
+    @property
+    def codes(self) -> Sequence[int]:
+        if self._codes is None:
+            self.store.load(self)
+        return self._codes
+
+    @property
+    def table(self) -> StringTable:
+        if self._table is None:
+            self.store.load(self)
+        return self._table
+
+    def __len__(self):
+        return self.height
+
+    def __iter__(self) -> Iterator[List[str]]:
+        return map(self.row, range(self.height))
+
+    def row_codes(self, index: int) -> Sequence[int]:
+        return self.codes[index * self.width:(index + 1) * self.width]
+
+    def row(self, index: int) -> List[str]:
+        strings = self.table.strings
+        return [strings[code] for code in self.row_codes(index)]
+
+    def rows(self) -> List[List[str]]:
+        return list(self)
+
+    def spill(self, directory: str) -> None:
+        """Writes the snapshot to a file once and drops it from memory"""
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(suffix=".snap", dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(len(self._codes).to_bytes(8, "little"))
+                f.write(array('I', self._codes).tobytes())
+                f.write(json.dumps(self._table.strings[:self.size]).encode())
+            weakref.finalize(self, os.remove, self.path)
+        self._codes = self._table = None
+
+    def load(self) -> None:
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count = int.from_bytes(data[:8], "little")
+        # Codes stay in the page cache and are read straight from the mapping
+        self._codes = memoryview(data)[8:8 + 4 * count].cast('I')
+        self._table = StringTable(json.loads(data[8 + 4 * count:]), self.table_id)
+
+
+class SnapshotStore:
+    """Latest snapshot of every (spreadsheet, worksheet). All checkers of one worksheet get
+    the same Snapshot object, and a new snapshot reuses the string table of the previous one
+    """
+    memory: int
+    spill_dir: str
+    resident: int
+
+    def __init__(self, memory: int = SNAPSHOT_MEMORY, spill_dir: str = SNAPSHOT_SPILL_DIR):
+        self.memory = memory
+        self.spill_dir = spill_dir
+        self.resident = 0
+        self.latest: OrderedDict[Hashable, Snapshot] = OrderedDict()
+        self.lock = threading.RLock()
+
+    def put(self, key: Hashable, rows: Sequence[Sequence[str]]) -> Snapshot:
+        with self.lock:
+            previous = self.latest.get(key)
+            table = previous.table if previous is not None else StringTable()
+            snapshot = self.encode(rows, table)
+            if len(table.strings) > 2 * len(snapshot.codes) + 1024:
+                # The table is mostly strings that are gone from the sheet
+                snapshot = self.encode(rows, StringTable())
+            if (previous is not None and previous.table_id == snapshot.table_id
+                    and previous.width == snapshot.width and previous.codes == snapshot.codes):
+                snapshot = previous
+            self.remember(key, snapshot)
+            self.shrink(key)
+            return snapshot
+
+    def encode(self, rows: Sequence[Sequence[str]], table: StringTable) -> Snapshot:
+        width = max(map(len, rows), default=0)
+        codes = array('I')
+        lookup = table.codes
+        empty = lookup['']
+        for row in rows:
+            codes.extend(map(lookup.__getitem__, row))
+            if len(row) < width:
+                codes.extend(itertools.repeat(empty, width - len(row)))
+        return Snapshot(codes, table, len(rows), width, self)
+
+    def remember(self, key: Hashable, snapshot: Snapshot) -> None:
+        previous = self.latest.pop(key, None)
+        if previous is snapshot:
+            self.latest[key] = snapshot
+            return
+        if previous is not None:
+            previous.key = None
+            if previous.resident:
+                self.resident -= previous.nbytes
+        snapshot.key = key
+        self.latest[key] = snapshot
+        self.resident += snapshot.nbytes
+
+    def load(self, snapshot: Snapshot) -> None:
+        with self.lock:
+            if snapshot.resident:
+                return
+            snapshot.load()
+            if snapshot.key is not None:
+                self.latest.move_to_end(snapshot.key)
+                self.resident += snapshot.nbytes
+            self.shrink(snapshot.key)
+
+    def shrink(self, keep: Optional[Hashable] = None) -> None:
+        """Spills the least recently put snapshots until the resident memory fits"""
+        if not self.spill_dir:
+            return
+        for key, snapshot in self.latest.items():
+            if self.resident <= self.memory:
+                break
+            if key != keep and snapshot.resident:
+                snapshot.spill(self.spill_dir)
+                self.resident -= snapshot.nbytes
+
+    def discard(self, key: Hashable) -> None:
+        with self.lock:
+            snapshot = self.latest.pop(key, None)
+            if snapshot is not None:
+                snapshot.key = None
+                if snapshot.resident:
+                    self.resident -= snapshot.nbytes
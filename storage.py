@@ -0,0 +1,137 @@
+import json
+import sqlite3
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import DATABASE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tables (
+    chat_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    min_interval REAL,
+    max_interval REAL,
+    PRIMARY KEY (chat_id, name)
+);
+CREATE TABLE IF NOT EXISTS checkers (
+    chat_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    checker TEXT NOT NULL,
+    PRIMARY KEY (chat_id, table_name, position)
+);
+CREATE TABLE IF NOT EXISTS states (
+    key TEXT PRIMARY KEY,
+    version TEXT,
+    data TEXT NOT NULL
+);
+"""
+
+
+class Storage:
+    """Subscriptions in SQLite in WAL mode. Only changed tables are written, each write is
+    a transaction, so a crash never leaves a half written base. Data of checkers is kept once
+    per checker key in states, however many tables share the checker
+    """
+    path: str
+
+    def __init__(self, path: str = DATABASE):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.migrate()
+        self.lock = threading.Lock()
+
+    def migrate(self) -> None:
+        """Adds columns that databases made by older versions don't have"""
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(tables)")}
+        with self.connection:
+            for column in ("min_interval", "max_interval"):
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE tables ADD COLUMN {column} REAL")
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(checkers)")}
+        with self.connection:
+            # Checkers written before have their data inline and no state
+            if "state_key" not in columns:
+                self.connection.execute("ALTER TABLE checkers ADD COLUMN state_key TEXT")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS checkers_state_key ON checkers (state_key)")
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM tables LIMIT 1").fetchone() is None
+
+    def load(self, decode: Callable[[dict], object]) -> Dict[str, dict]:
+        """:returns tables by name by chat id, decode builds tables and checkers from dicts"""
+        with self.lock:
+            tables = self.connection.execute(
+                "SELECT chat_id, name, ref, min_interval, max_interval FROM tables").fetchall()
+            checkers = self.connection.execute(
+                "SELECT chat_id, table_name, checker FROM checkers ORDER BY position").fetchall()
+        checkers_by_table = {}
+        for chat_id, table_name, checker in checkers:
+            checkers_by_table.setdefault((chat_id, table_name), []).append(
+                json.loads(checker, object_hook=decode))
+        base = {}
+        for chat_id, name, ref, min_interval, max_interval in tables:
+            base.setdefault(chat_id, {})[name] = decode(
+                {"name": name, "ref": ref, "type": "Table", "min_interval": min_interval,
+                 "max_interval": max_interval,
+                 "checkers": checkers_by_table.get((chat_id, name), [])})
+        return base
+
+    def versions(self) -> Dict[str, Optional[str]]:
+        """:returns versions of the checkers' states by checker key, the data is read apart"""
+        with self.lock:
+            return dict(self.connection.execute("SELECT key, version FROM states"))
+
+    def state(self, key: str) -> Optional[str]:
+        """:returns JSON data of the checker, None if it's gone"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM states WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def write(self, changes: Iterable[Tuple[str, str, Optional[dict]]],
+              states: List[Tuple[str, Optional[str], str]] = ()) -> None:
+        """Takes (chat_id, name, table) triples and (key, version, data) states of checkers.
+        Table is an encoded table with "checkers" as a list of (JSON, state key) pairs, or None
+        for a deleted table. States nobody refers to anymore are deleted"""
+        changes = list(changes)
+        # States of the removed checker rows and the written ones may be left without
+        # references, only they are checked rather than the whole states table
+        unreferenced = {key for key, _, _ in states}
+        with self.lock, self.connection:
+            for chat_id, name, table in changes:
+                unreferenced.update(key for key, in self.connection.execute(
+                    "SELECT state_key FROM checkers WHERE chat_id = ? AND table_name = ?"
+                    " AND state_key IS NOT NULL", (chat_id, name)))
+                self.connection.execute(
+                    "DELETE FROM checkers WHERE chat_id = ? AND table_name = ?", (chat_id, name))
+                if table is None:
+                    self.connection.execute(
+                        "DELETE FROM tables WHERE chat_id = ? AND name = ?", (chat_id, name))
+                    continue
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO tables (chat_id, name, ref, min_interval, max_interval)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (chat_id, name, table["ref"], table.get("min_interval"),
+                     table.get("max_interval")))
+                self.connection.executemany(
+                    "INSERT INTO checkers (chat_id, table_name, position, checker, state_key)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    ((chat_id, name, position, checker, key)
+                     for position, (checker, key) in enumerate(table["checkers"])))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO states (key, version, data) VALUES (?, ?, ?)", states)
+            self.connection.executemany(
+                "DELETE FROM states WHERE key = ? AND NOT EXISTS"
+                " (SELECT 1 FROM checkers WHERE state_key = ?)",
+                ((key, key) for key in unreferenced))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,45 @@
+from typing import Dict, Hashable, Iterable, List, Set
+
+
+class SubscriptionIndex:
+    """Shared checkers by their key with the subscribers of each. Equal checkers of different
+    chats and tables are one object, so every watched range is fetched and diffed once
+    """
+    checkers: Dict[Hashable, object]
+    subscribers: Dict[Hashable, Set[Hashable]]
+
+    def __init__(self):
+        self.checkers = {}
+        self.subscribers = {}
+
+    def __len__(self):
+        return len(self.checkers)
+
+    def __contains__(self, checker):
+        return checker.key in self.checkers
+
+    def subscribe(self, checker, subscriber: Hashable):
+        """:returns the shared checker equal to the given one, the given one if it's new"""
+        shared = self.checkers.setdefault(checker.key, checker)
+        self.subscribers.setdefault(checker.key, set()).add(subscriber)
+        return shared
+
+    def unsubscribe(self, checker, subscriber: Hashable) -> None:
+        """The checker is dropped and released with its last subscriber"""
+        subscribers = self.subscribers.get(checker.key)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self.subscribers[checker.key]
+            self.checkers.pop(checker.key).release()
+
+    def fan_out(self, checkers: Iterable) -> Dict[Hashable, List]:
+        """:returns the given polled checkers of every subscriber, whichever table's poll
+        they were fetched for
+        """
+        polled: Dict[Hashable, List] = {}
+        for checker in checkers:
+            for subscriber in self.subscribers.get(checker.key, ()):
+                polled.setdefault(subscriber, []).append(checker)
+        return polled
@@ -0,0 +1,24 @@
+import pytest
+
+from checkers import ColChecker, RangeChecker
+
+
+def test_parse_ranges():
+    assert RangeChecker.parse("b2:k40, M1:M5") == ["B2:K40", "M1:M5"]
+    assert RangeChecker.parse("A1 C:C;2:3") == ["A1", "C:C", "2:3"]
+
+
+@pytest.mark.parametrize("text", ["", " , ", "A", "1", "A1:", "Лист1!A1", "A1-B2"])
+def test_parse_rejects_what_is_not_a1(text):
+    with pytest.raises(ValueError):
+        RangeChecker.parse(text)
+
+
+def test_column_edits_stay_in_place_among_repeated_values():
+    checker = ColChecker("https://docs.google.com/spreadsheets/d/key/edit", 0, 1)
+    checker.data = ["yes", "no", ""] * 100
+    new = list(checker.data)
+    new[32], new[270] = "no", ""
+    checker.get_news(new)
+    assert checker.answer == ("Изменена ячейка A33 с  на no\n"
+                              "Изменена ячейка A271 с yes на \n")
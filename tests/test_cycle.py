@@ -0,0 +1,76 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from bot import Table
+from checkers import CellChecker
+from cycle import PollCycle
+from fake_sheets import FakeClient
+from fetcher import FetchPlanner
+from governor import Account, AccountPool, Governor, Quota
+from scheduler import AdaptivePolicy, PollScheduler
+from subscriptions import SubscriptionIndex
+
+
+def make_cycle(reads: float = 10 ** 6):
+    client = FakeClient()
+    for key in ("first", "second"):
+        client.add_spreadsheet(key, 1, 5, 5).sheets[0].grid[0][0] = "a"
+    account = Account("test", Quota(reads), lambda _: client)
+    planner = FetchPlanner(Governor(AccountPool([account])))
+    tables, news, saved = {}, {}, []
+    cycle = PollCycle(planner, SubscriptionIndex(), AdaptivePolicy(floor=10, ceiling=40),
+                      PollScheduler(), ThreadPoolExecutor(2), lambda key: (key, tables[key]),
+                      news.__setitem__, saved.append)
+    return client, cycle, tables, news, saved
+
+
+def watch(cycle, tables, name: str, key: str) -> CellChecker:
+    table = Table(f"https://docs.google.com/spreadsheets/d/{key}/edit", name)
+    table.interval = 20
+    checker = cycle.subscriptions.subscribe(CellChecker(table.reference, 0, "A1"), ("c", name))
+    table.add_checker(checker)
+    tables["c", name] = table
+    cycle.scheduler.add(("c", name), table.interval)
+    return checker
+
+
+def test_news_of_a_shared_checker_go_to_every_table():
+    client, cycle, tables, news, saved = make_cycle()
+    checker = watch(cycle, tables, "t1", "first")
+    watch(cycle, tables, "t2", "first")
+    assert asyncio.run(cycle.poll([("c", "t1")])) == set()
+    assert saved == [checker]
+    client.mutate("first")
+    client.spreadsheets["first"].sheets[0].grid[0][0] = "b"
+    assert asyncio.run(cycle.poll([("c", "t1")])) == {("c", "t1"), ("c", "t2")}
+    assert news == {("c", "t1"): "Ячейка A1 изменена с a на b\n",
+                    ("c", "t2"): "Ячейка A1 изменена с a на b\n"}
+    # Only the polled table's interval adapts
+    assert tables["c", "t1"].interval == 10 and tables["c", "t2"].interval == 20
+    assert not cycle.polling
+
+
+def test_failed_spreadsheet_leaves_the_others_fanned_out(monkeypatch):
+    _, cycle, tables, news, _ = make_cycle()
+    failed = watch(cycle, tables, "t1", "first")
+    polled = watch(cycle, tables, "t2", "second")
+    poll = cycle.planner.poll_spreadsheet
+
+    def fail(key, checkers):
+        if key == "first":
+            raise RuntimeError("token refresh failed")
+        return poll(key, checkers)
+
+    monkeypatch.setattr(cycle.planner, "poll_spreadsheet", fail)
+    asyncio.run(cycle.poll([("c", "t1"), ("c", "t2")]))
+    assert not failed.fed and polled.fed
+    assert not cycle.polling
+
+
+def test_spreadsheets_without_reads_are_deferred():
+    client, cycle, tables, _, _ = make_cycle(reads=1)
+    cycle.planner.governor.pool.accounts[0].quota.tokens = 0
+    watch(cycle, tables, "t1", "first")
+    deferred = []
+    assert asyncio.run(cycle.poll([("c", "t1")], deferred.append)) == set()
+    assert deferred == [("c", "t1")] and client.calls["version"] == 0
@@ -0,0 +1,76 @@
+import random
+
+import diff
+from diff import RowEvent, align, align_rows, diff_snapshots, diff_snapshots_aligned
+from snapshots import SnapshotStore
+
+
+def test_align_matches_around_an_insert():
+    assert align("abcd", "abxcd") == [(0, 0), (1, 1), (2, 3), (3, 4)]
+
+
+def test_align_anchors_on_unique_rows():
+    assert align("abcd", "dabc") == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_align_leaves_a_big_gap_of_repeated_rows_unmatched(monkeypatch):
+    assert align("xabay", "xbaby") == [(0, 0), (1, 2), (2, 3), (4, 4)]
+    monkeypatch.setattr(diff, "ALIGN_GAP_LIMIT", 0)
+    assert align("xabay", "xbaby") == [(0, 0), (4, 4)]
+
+
+def test_runs_merge_consecutive_rows():
+    assert diff._runs("move", [(0, 3), (1, 4), (3, 6)]) == [
+        RowEvent("move", 1, 4, 2), RowEvent("move", 4, 7, 1)]
+    assert diff._runs("insert", [(-1, 2), (-1, 3), (-1, 7)]) == [
+        RowEvent("insert", 0, 3, 2), RowEvent("insert", 0, 8, 1)]
+    assert diff._runs("delete", []) == []
+
+
+def test_align_rows_finds_moves():
+    assert align_rows("abcd", "dabc") == ([RowEvent("move", 4, 1, 1)], [])
+    assert align_rows("abcd", "badc") == (
+        [RowEvent("move", 1, 2, 1), RowEvent("move", 3, 4, 1)], [])
+
+
+def test_align_rows_with_repeated_rows():
+    assert align_rows("aab", "aaab") == ([RowEvent("insert", 0, 3, 1)], [])
+    assert align_rows("abab", "ab") == ([RowEvent("delete", 3, 0, 2)], [])
+
+
+def test_align_rows_gap_limit_fallback(monkeypatch):
+    assert align_rows("xabay", "xbaby") == (
+        [RowEvent("delete", 4, 0, 1), RowEvent("insert", 0, 2, 1)], [])
+    monkeypatch.setattr(diff, "ALIGN_GAP_LIMIT", 0)
+    assert align_rows("xabay", "xbaby") == (
+        [RowEvent("move", 2, 3, 1), RowEvent("move", 3, 2, 1)], [(3, 3)])
+
+
+def test_align_rows_keeps_edits_in_place():
+    assert align_rows("abcd", "abXd") == ([], [(2, 2)])
+    assert align_rows("abcd", "XbcY") == ([], [(0, 0), (3, 3)])
+
+
+def test_aligned_snapshots_match_positional_diff_of_edits():
+    rng = random.Random(0)
+    rows = [[str(rng.randrange(100)) for _ in range(5)] for _ in range(200)]
+    edited = [row[:] for row in rows]
+    for _ in range(10):
+        edited[rng.randrange(200)][rng.randrange(5)] = "x"
+    store = SnapshotStore()
+    old, new = store.put("key", rows), store.put("key", edited)
+    assert diff_snapshots_aligned(old, new) == ([], diff_snapshots(old, new))
+
+
+def test_cleared_last_row_is_reported_by_its_cells():
+    store = SnapshotStore()
+    old = store.put("key", [["a", "b"], ["c", ""], ["e", "f"], ["", "j"]])
+    new = store.put("key", [["a", "b"], ["c", ""], ["e", "f"]])
+    assert diff_snapshots_aligned(old, new) == ([], [diff.Change(4, 2, "j", "")])
+
+
+def test_rows_deleted_in_the_middle_stay_events():
+    store = SnapshotStore()
+    old = store.put("key", [["a"], ["b"], ["c"], ["d"]])
+    new = store.put("key", [["a"], ["c"], ["d"]])
+    assert diff_snapshots_aligned(old, new) == ([RowEvent("delete", 2, 0, 1)], [])
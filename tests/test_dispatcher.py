@@ -0,0 +1,21 @@
+from dispatcher import split_message
+
+
+def test_short_text_is_one_message():
+    assert split_message("a\nb\n", limit=10) == ["a\nb\n"]
+    assert split_message("", limit=10) == []
+
+
+def test_split_at_line_ends():
+    assert split_message("aaaa\nbbbb\ncccc\n", limit=10) == ["aaaa\nbbbb\n", "cccc\n"]
+
+
+def test_long_line_is_cut():
+    assert split_message("ab\n" + "x" * 12 + "\ncd", limit=5) == [
+        "ab\n", "xxxxx", "xxxxx", "xx\ncd"]
+
+
+def test_parts_fit_the_limit_and_keep_the_text():
+    text = "".join(f"line {i}\n" * (i % 4) + "y" * (i * 3) for i in range(30))
+    parts = split_message(text, limit=50)
+    assert "".join(parts) == text and all(len(part) <= 50 for part in parts)
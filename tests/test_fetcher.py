@@ -0,0 +1,120 @@
+import json
+from urllib.parse import unquote
+
+import gspread
+import pytest
+import requests
+
+from checkers import CellChecker, RangeChecker, RowChecker
+from fake_sheets import FakeClient
+from fetcher import FetchPlanner
+from governor import Account, AccountPool, Governor, Quota
+
+KEY = "spreadsheet"
+REF = f"https://docs.google.com/spreadsheets/d/{KEY}/edit"
+
+
+class MockSession(requests.Session):
+    """Answers the Drive and Sheets requests of one spreadsheet with a 3 x 3 worksheet"""
+
+    def __init__(self):
+        super().__init__()
+        self.version = 1
+        self.cells = {"A1": "a", "B2": "b"}
+        self.urls = []
+
+    def request(self, method, url, params=None, **kwargs):
+        self.urls.append(url)
+        if url.startswith("https://www.googleapis.com/drive/v3/files/"):
+            body = {"version": str(self.version)}
+        elif url.endswith(":batchGet"):
+            ranges = params["ranges"] if isinstance(params, dict) else [
+                value for name, value in params if name == "ranges"]
+            body = {"valueRanges": [
+                {"range": name, "values": [[self.cells.get(unquote(name).split("!")[-1], "")]]}
+                for name in ranges]}
+        else:
+            body = {"properties": {"title": "Table"}, "sheets": [{"properties": {
+                "title": "Лист1", "sheetId": 0, "index": 0,
+                "gridProperties": {"rowCount": 3, "columnCount": 3}}}]}
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(body).encode()
+        response.url = url
+        return response
+
+
+def make_planner(client) -> FetchPlanner:
+    account = Account("test", Quota(10 ** 6), lambda _: client)
+    return FetchPlanner(Governor(AccountPool([account])))
+
+
+def test_poll_with_a_real_client():
+    session = MockSession()
+    planner = make_planner(gspread.Client(None, session=session))
+    checker = CellChecker(REF, 0, "A1")
+    planner.poll_spreadsheet(KEY, [checker])
+    assert checker.fed and checker.data == "a" and checker.version == "1"
+    session.cells["A1"] = "c"
+    session.version = 2
+    planner.poll_spreadsheet(KEY, [checker])
+    assert checker.answer == "Ячейка A1 изменена с a на c\n"
+    requests_made = len(session.urls)
+    planner.poll_spreadsheet(KEY, [checker])
+    # The same version is a single Drive request
+    assert len(session.urls) == requests_made + 1 and checker.answer == ''
+
+
+def fake_planner(worksheets: int = 2):
+    client = FakeClient()
+    spreadsheet = client.add_spreadsheet(KEY, worksheets, 5, 5)
+    spreadsheet.sheets[0].grid[0][0] = "a"
+    return client, spreadsheet, make_planner(client)
+
+
+def test_one_values_request_per_spreadsheet():
+    client, _, planner = fake_planner()
+    checkers = [CellChecker(REF, 0, "A1"), CellChecker(REF, 0, "A1"),
+                RangeChecker(REF, 1, ["B2:C3"]), RowChecker(REF, 0, 2)]
+    planner.poll_spreadsheet(KEY, checkers)
+    assert client.calls == {"version": 1, "metadata": 2, "values": 1}
+    assert all(checker.fed for checker in checkers)
+    assert checkers[0].data == checkers[1].data == "a"
+
+
+def test_unchanged_version_skips_values():
+    client, spreadsheet, planner = fake_planner()
+    checker = CellChecker(REF, 0, "A1")
+    planner.poll_spreadsheet(KEY, [checker])
+    planner.poll_spreadsheet(KEY, [checker])
+    assert client.calls["version"] == 2 and client.calls["values"] == 1
+    client.mutate(KEY)
+    spreadsheet.sheets[0].grid[0][0] = "b"
+    planner.poll_spreadsheet(KEY, [checker])
+    assert client.calls["values"] == 2
+    assert checker.answer == "Ячейка A1 изменена с a на b\n"
+
+
+def test_missing_worksheet_leaves_the_others_polled():
+    _, _, planner = fake_planner(worksheets=1)
+    present, missing = CellChecker(REF, 0, "A1"), CellChecker(REF, 1, "A1")
+    planner.poll_spreadsheet(KEY, [present, missing])
+    assert present.fed and present.data == "a"
+    assert not missing.fed and missing.answer == ''
+    assert not planner.governor.breaker.failures
+    with pytest.raises(gspread.WorksheetNotFound):
+        planner.fetch([CellChecker(REF, 1, "B2")])
+
+
+def test_unexpected_error_leaves_no_stale_news(monkeypatch):
+    _, _, planner = fake_planner()
+    checker = CellChecker(REF, 0, "A1")
+    checker.answer = "Ячейка A1 изменена с b на a\n"
+
+    def fail(*args):
+        raise RuntimeError("token refresh failed")
+
+    monkeypatch.setattr(planner, "fetch_spreadsheet", fail)
+    with pytest.raises(RuntimeError):
+        planner.poll_spreadsheet(KEY, [checker])
+    assert checker.answer == ''
@@ -0,0 +1,25 @@
+from bot import parse_interval
+from scheduler import AdaptivePolicy
+
+
+def test_parse_interval_bounds():
+    assert parse_interval(["Budget", "5"], {"Budget"}) == ("Budget", [300])
+    assert parse_interval(["Budget", "5", "10"], {"Budget"}) == ("Budget", [300, 600])
+    assert parse_interval(["Budget", "10", "5"], {"Budget"}) == ("Budget", [])
+    assert parse_interval(["Budget", "nan"], {"Budget"}) == ("Budget", [])
+    assert parse_interval(["Budget", "0"], {"Budget"}) == ("Budget", [])
+    assert parse_interval(["Budget"], {"Budget"}) == ("Budget", [])
+
+
+def test_parse_interval_name_ending_in_a_number():
+    assert parse_interval(["Budget", "2024", "5"], {"Budget 2024"}) == ("Budget 2024", [300])
+    assert parse_interval(["Budget", "2024", "5"], {"Budget", "Budget 2024"}) == (
+        "Budget 2024", [300])
+    assert parse_interval(["Budget", "5", "10"], {"Budget", "Budget 5"}) == ("Budget", [300, 600])
+
+
+def test_pinned_floor_is_clamped_to_the_minimum():
+    policy = AdaptivePolicy(floor=60, ceiling=600, minimum=30)
+    assert policy.bounds(0.06) == (30, 600)
+    assert policy.bounds(120, 90) == (120, 120)
+    assert policy.after_poll(30, changed=True, min_interval=1) == 30
@@ -0,0 +1,40 @@
+import json
+
+import gspread
+import requests
+
+from governor import Account, AccountPool, Governor, Quota
+from push import PushChannels
+
+
+class MockSession(requests.Session):
+    """Answers Drive files.watch and channels.stop"""
+
+    def __init__(self):
+        super().__init__()
+        self.urls = []
+
+    def request(self, method, url, **kwargs):
+        self.urls.append(url)
+        body = {}
+        if url.endswith("/watch"):
+            watch = kwargs["json"]
+            body = {"id": watch["id"], "resourceId": "resource", "expiration": watch["expiration"]}
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(body).encode()
+        return response
+
+
+def test_open_and_close_with_a_real_client():
+    session = MockSession()
+    client = gspread.Client(None, session=session)
+    governor = Governor(AccountPool([Account("test", Quota(10 ** 6), lambda _: client)]))
+    channels = PushChannels(governor, "https://bot.example/drive", token="secret")
+    channel = channels.open("key")
+    assert channels.live("key") and channel.resource_id == "resource"
+    assert channels.receive({"x-goog-channel-token": "secret", "x-goog-channel-id": channel.id,
+                             "x-goog-resource-id": "resource",
+                             "x-goog-resource-state": "update"}) == "key"
+    channels.close("key")
+    assert not channels.live("key") and session.urls[-1].endswith("/channels/stop")
@@ -0,0 +1,52 @@
+from scheduler import AdaptivePolicy, PollScheduler
+
+
+def test_due_items_are_rescheduled_by_their_interval():
+    scheduler = PollScheduler(jitter=0)
+    scheduler.push("a", 10, 5)
+    scheduler.push("b", 20, 30)
+    assert scheduler.pop_due(now=4) == []
+    assert scheduler.pop_due(now=5) == ["a"]
+    assert scheduler.pop_due(now=15) == ["a"]
+    assert sorted(scheduler.pop_due(now=30)) == ["a", "b"]
+    assert len(scheduler) == 2
+
+
+def test_first_poll_falls_within_the_interval():
+    scheduler = PollScheduler(jitter=0)
+    for item in range(100):
+        scheduler.add(item, 10, now=0)
+    assert sorted(scheduler.pop_due(now=10)) == list(range(100))
+
+
+def test_remove_reschedule_and_postpone():
+    scheduler = PollScheduler(jitter=0)
+    scheduler.push("a", 10, 0)
+    scheduler.push("b", 10, 0)
+    scheduler.remove("b")
+    assert "b" not in scheduler
+    scheduler.reschedule("a", 60, now=0)
+    assert scheduler.pop_due(now=59) == []
+    scheduler.postpone("a", 1, now=59)
+    assert scheduler.pop_due(now=60) == ["a"]
+    # Postponing keeps the interval
+    assert scheduler.pop_due(now=119) == [] and scheduler.pop_due(now=120) == ["a"]
+    scheduler.postpone("b", 1)
+    assert "b" not in scheduler
+
+
+def test_lag_of_the_most_overdue_item():
+    scheduler = PollScheduler(jitter=0)
+    assert scheduler.lag(now=100) == 0
+    scheduler.push("a", 10, 40)
+    scheduler.push("b", 10, 70)
+    assert scheduler.lag(now=100) == 60
+    scheduler.remove("a")
+    assert scheduler.lag(now=100) == 30
+
+
+def test_adaptive_interval_backs_off_and_resets():
+    policy = AdaptivePolicy(floor=10, ceiling=40)
+    assert policy.after_poll(10, changed=False) > 10
+    assert policy.after_poll(40, changed=False) == 40
+    assert policy.after_poll(40, changed=True) == 10
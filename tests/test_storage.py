@@ -0,0 +1,26 @@
+from storage import Storage
+
+
+def table(*keys):
+    return {"ref": "ref", "checkers": [(f'{{"key": "{key}"}}', key) for key in keys]}
+
+
+def test_shared_state_lives_while_referenced(tmp_path):
+    storage = Storage(str(tmp_path / "base.sqlite3"))
+    storage.write([("1", "a", table("k")), ("2", "b", table("k", "m"))],
+                  [("k", "v1", "[1]"), ("m", "v1", "[2]")])
+    assert storage.versions() == {"k": "v1", "m": "v1"}
+    storage.write([("1", "a", None)])
+    assert storage.state("k") == "[1]"
+    storage.write([("2", "b", table("m"))])
+    assert storage.versions() == {"m": "v1"}
+    storage.write([("2", "b", None)])
+    assert storage.versions() == {}
+    storage.close()
+
+
+def test_state_without_checkers_is_not_kept(tmp_path):
+    storage = Storage(str(tmp_path / "base.sqlite3"))
+    storage.write([], [("k", "v1", "[1]")])
+    assert storage.state("k") is None
+    storage.close()
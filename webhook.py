@@ -0,0 +1,108 @@
+"""Webhook mode: Telegram posts updates to the embedded HTTP server instead of the bot
+long-polling getUpdates
+"""
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+import signal
+from typing import Dict, Iterable, List
+from urllib.parse import urlsplit
+
+from telegram import Update
+from telegram.ext import Application, BaseHandler, BaseUpdateProcessor, CommandHandler, \
+    ConversationHandler, MessageHandler
+
+from config import WEBHOOK_CONNECTIONS, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL
+from httpd import Request, serve
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Handles updates of different chats concurrently and updates of one chat in order,
+    so a conversation never gets the next message before the previous one is handled
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.locks: Dict[int, asyncio.Lock] = {}
+        # Updates holding or waiting for the lock of a chat
+        self.users: Dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        lock = self.locks.setdefault(chat.id, asyncio.Lock())
+        self.users[chat.id] = self.users.get(chat.id, 0) + 1
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            self.users[chat.id] -= 1
+            if not self.users[chat.id]:
+                del self.users[chat.id], self.locks[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+def used_update_types(handlers: Iterable[BaseHandler]) -> List[str]:
+    """Update types the handlers react to. Command and message handlers only need new
+    messages: edited ones and channel posts are not asked for
+    """
+    types = set()
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            types.update(used_update_types(
+                handler.entry_points + handler.fallbacks +
+                [state for states in handler.states.values() for state in states]))
+        elif isinstance(handler, (CommandHandler, MessageHandler)):
+            types.add(Update.MESSAGE)
+        else:
+            return Update.ALL_TYPES
+    return sorted(types)
+
+
+def run_webhook(app: Application, allowed_updates: List[str]) -> None:
+    """Runs the bot until SIGINT or SIGTERM"""
+    asyncio.run(serve_webhook(app, allowed_updates))
+
+
+async def serve_webhook(app: Application, allowed_updates: List[str]) -> None:
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+    async def receive(request: Request):
+        if request.method != "POST":
+            return 405, "text/plain", b"POST only"
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            return 403, "text/plain", b"wrong secret token"
+        try:
+            update = Update.de_json(json.loads(request.body), app.bot)
+        except ValueError:
+            return 400, "text/plain", b"bad update"
+        await app.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with app:
+        await app.start()
+        server = await serve({urlsplit(WEBHOOK_URL).path or "/": receive},
+                             WEBHOOK_HOST, WEBHOOK_PORT)
+        await app.bot.set_webhook(WEBHOOK_URL, secret_token=secret,
+                                  allowed_updates=allowed_updates,
+                                  max_connections=WEBHOOK_CONNECTIONS)
+        logging.info("Webhook %s is on %s:%s", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT)
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            await app.stop()
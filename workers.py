@@ -0,0 +1,273 @@
+"""Poller worker processes. Every worker owns the spreadsheets that consistent hashing of
+their IDs gives it, polls their tables and sends news back to the bot process
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import POLL_TICK, POLL_WORKERS
+from cycle import PollCycle, TableKey
+from hashring import HashRing
+from scheduler import AdaptivePolicy, PollScheduler
+from subscriptions import SubscriptionIndex
+
+
+class Worker:
+    """Polling loop inside a worker process.
+    Commands: ("watch", key, payload), ("unwatch", key), ("release", key), ("touch", key),
+    ("quota", None, shares), ("stop",). Results: ("news", key, news),
+    ("state", checker key, (version, data)), ("released", key, payload), where payload is
+    a table encoded to JSON with its checkers' data and data is JSON of one checker's data
+    """
+
+    def __init__(self, name: str, results: multiprocessing.Queue):
+        # The bot module imports this one, so it is imported only inside the worker
+        from bot import BaseHelper
+        from checkers import planner
+        self.name = name
+        self.results = results
+        self.helper = BaseHelper
+        self.planner = planner
+        # Commands run in the bot process, a worker's reads are all for polls
+        planner.governor.reserve = 0
+        self.tables = {}
+        self.subscriptions = SubscriptionIndex()
+        self.scheduler = PollScheduler()
+        self.policy = AdaptivePolicy()
+        self.executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix="poll")
+        self.cycle = PollCycle(planner, self.subscriptions, self.policy, self.scheduler,
+                               self.executor, lambda key: (key, self.tables[key]),
+                               self.send_news, self.send_state)
+        # The cycle is a coroutine, polls run it to completion on this loop
+        self.loop = asyncio.new_event_loop()
+
+    def run(self, commands: multiprocessing.Queue) -> None:
+        while True:
+            try:
+                command = commands.get(timeout=POLL_TICK)
+                while True:
+                    if not self.handle(*command):
+                        return
+                    command = commands.get_nowait()
+            except queue.Empty:
+                pass
+            due = self.scheduler.pop_due()
+            if due:
+                self.poll(due)
+
+    def encode(self, table) -> str:
+        return json.dumps(table, default=self.helper.encode)
+
+    def handle(self, kind: str, key: Optional[TableKey] = None, payload: str = '') -> bool:
+        match kind:
+            case "watch":
+                table = json.loads(payload, object_hook=self.helper.decode)
+                # Checkers already watched here have fresher data than the bot's copy
+                table.subscribe(self.subscriptions, key)
+                previous = self.tables.get(key)
+                if previous is not None:
+                    for checker in previous.checkers:
+                        if checker not in table.checkers:
+                            self.subscriptions.unsubscribe(checker, key)
+                    table.interval = previous.interval
+                self.tables[key] = table
+                if key not in self.scheduler:
+                    self.scheduler.add(key, table.interval)
+            case "unwatch":
+                table = self.tables.pop(key, None)
+                self.scheduler.remove(key)
+                if table is not None:
+                    table.unsubscribe(self.subscriptions, key)
+            case "release":
+                table = self.tables.pop(key, None)
+                self.scheduler.remove(key)
+                if table is not None:
+                    table.unsubscribe(self.subscriptions, key)
+                self.results.put(("released", key, None if table is None else self.encode(table)))
+            case "touch":
+                table = self.tables.get(key)
+                if table is not None:
+                    table.interval = self.policy.bounds(table.min_interval, table.max_interval)[0]
+                    self.scheduler.reschedule(key, table.interval)
+            case "quota":
+                self.planner.governor.share(int(payload))
+            case "stop":
+                return False
+        return True
+
+    def send_news(self, key: TableKey, news: str) -> None:
+        self.results.put(("news", key, news))
+
+    def send_state(self, checker) -> None:
+        """A shared checker's state is sent once, whatever number of tables watch it"""
+        self.results.put(("state", checker.key, (checker.version, checker.state())))
+        checker.dirty = False
+
+    def poll(self, keys: List[TableKey]) -> None:
+        """Polls every checker of the tables once, news go to all tables sharing a checker"""
+        self.loop.run_until_complete(self.cycle.poll(keys))
+
+
+def run_worker(name: str, commands: multiprocessing.Queue,
+               results: multiprocessing.Queue) -> None:
+    logging.info("Poller %s has started", name)
+    Worker(name, results).run(commands)
+
+
+class ShardManager:
+    """Runs poller workers from the bot process and keeps every table on exactly one of them.
+    When workers are added or removed, a moving table is first released by its old owner,
+    which sends back its latest data, and only then watched by the new one, so no change is
+    reported twice
+    """
+
+    def __init__(self, count: int, payload: Callable[[TableKey], Optional[str]],
+                 share: Callable[[int], None] = lambda shares: None):
+        """:param payload returns the bot's own encoding of a table, used when a worker dies
+        :param share gives the bot process its part of the accounts' quotas"""
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.payload = payload
+        self.share = share
+        self.workers: Dict[str, Tuple[multiprocessing.Process, multiprocessing.Queue]] = {}
+        self.retiring = set()
+        self.counter = 0
+        # Table placement: spreadsheet ID, current owner and, for moving tables, the new owner
+        # with the bot's newer encoding if the table changed while moving
+        self.spreadsheets: Dict[TableKey, str] = {}
+        self.owners: Dict[TableKey, str] = {}
+        self.moving: Dict[TableKey, Optional[Tuple[str, Optional[str]]]] = {}
+        for _ in range(count):
+            self.spawn()
+        self.ring = HashRing(list(self.workers))
+        self.share_quota()
+
+    def spawn(self, name: Optional[str] = None) -> str:
+        if name is None:
+            name = f"poller-{self.counter}"
+            self.counter += 1
+        commands = self.context.Queue()
+        process = self.context.Process(target=run_worker, args=(name, commands, self.results),
+                                       name=name, daemon=True)
+        process.start()
+        self.workers[name] = process, commands
+        return name
+
+    def send(self, worker: str, *command) -> None:
+        self.workers[worker][1].put(command)
+
+    def share_quota(self, workers: Optional[List[str]] = None) -> None:
+        """Every worker and the bot process itself use the same accounts, so each of them
+        gets an equal part of the quotas. Retiring workers count until they stop"""
+        shares = len(self.workers) + 1
+        self.share(shares)
+        for name in self.workers if workers is None else workers:
+            self.send(name, "quota", None, str(shares))
+
+    def watch(self, key: TableKey, spreadsheet_id: str, payload: str) -> None:
+        self.spreadsheets[key] = spreadsheet_id
+        if key in self.moving:
+            target = self.moving[key]
+            self.moving[key] = (target[0] if target else self.ring.node_for(spreadsheet_id),
+                                payload)
+            return
+        owner = self.owners.setdefault(key, self.ring.node_for(spreadsheet_id))
+        self.send(owner, "watch", key, payload)
+
+    def unwatch(self, key: TableKey) -> None:
+        self.spreadsheets.pop(key, None)
+        if key in self.moving:
+            self.moving[key] = None
+            return
+        owner = self.owners.pop(key, None)
+        if owner is not None:
+            self.send(owner, "unwatch", key)
+
+    def touch(self, key: TableKey) -> None:
+        if key in self.owners and key not in self.moving:
+            self.send(self.owners[key], "touch", key)
+
+    def __len__(self):
+        return len(self.workers) - len(self.retiring)
+
+    def resize(self, count: int) -> None:
+        """Starts or retires workers and moves tables to their new owners"""
+        active = [name for name in self.workers if name not in self.retiring]
+        for _ in range(count - len(active)):
+            active.append(self.spawn())
+        for name in active[count:]:
+            self.retiring.add(name)
+        self.ring = HashRing(active[:count])
+        self.share_quota()
+        for key, owner in self.owners.items():
+            target = self.ring.node_for(self.spreadsheets[key])
+            if target != owner and key not in self.moving:
+                self.moving[key] = (target, None)
+                self.send(owner, "release", key)
+
+    def collect(self) -> List[tuple]:
+        """:returns news and state results, handles the others itself"""
+        self.check_workers()
+        collected = []
+        while True:
+            try:
+                kind, key, payload = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "released":
+                self.place(key, payload)
+            else:
+                collected.append((kind, key, payload))
+        self.stop_retired()
+        return collected
+
+    def place(self, key: TableKey, payload: Optional[str]) -> None:
+        """Hands a released table to its new owner"""
+        target = self.moving.pop(key, None)
+        if target is None or payload is None:
+            self.owners.pop(key, None)
+            return
+        owner, newer = target
+        self.owners[key] = owner
+        self.send(owner, "watch", key, payload)
+        if newer is not None:
+            self.send(owner, "watch", key, newer)
+
+    def check_workers(self) -> None:
+        """Restarts dead workers and gives them their tables back"""
+        for name, (process, _) in list(self.workers.items()):
+            if process.is_alive() or name in self.retiring:
+                continue
+            logging.error("Poller %s has died with code %s, restarting", name, process.exitcode)
+            self.spawn(name)
+            self.share_quota([name])
+            for key, owner in list(self.owners.items()):
+                if owner != name:
+                    continue
+                payload = self.payload(key)
+                if key in self.moving:
+                    self.place(key, payload)
+                elif payload is not None:
+                    self.send(name, "watch", key, payload)
+
+    def stop_retired(self) -> None:
+        stopped = False
+        for name in list(self.retiring):
+            if name in self.owners.values():
+                continue
+            self.send(name, "stop")
+            self.workers.pop(name)[0].join(timeout=5)
+            self.retiring.discard(name)
+            stopped = True
+        if stopped:
+            self.share_quota()
+
+    def stop(self) -> None:
+        for name in self.workers:
+            self.send(name, "stop")
+        for process, _ in self.workers.values():
+            process.join(timeout=5)